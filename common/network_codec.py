@@ -0,0 +1,120 @@
+# shared by the dash app and the worker, which mount this directory and have
+# it on their PYTHONPATH, so both always read and write the same format
+import json
+import struct
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+
+# binary layout, after the magic prefix and zlib compression:
+#   uint32 header length, json header with the interned ids,
+#   int32 src[n_edges], int32 trg[n_edges], int8 mor[n_edges]
+# edges are sorted by (src, trg) and ids are sorted, so a given network always
+# encodes to the same bytes and the content hash can be used as its identity
+MAGIC = b'NLBNET1\n'
+
+CompactNetwork = namedtuple('CompactNetwork', ['src_ids', 'trg_ids', 'src', 'trg', 'mor'])
+
+
+def _mor_array(mor):
+    # modes of regulation are stored as int8. Anything that doesn't survive
+    # the cast unchanged (fractions, nan, out of range) is an error, not a
+    # value to truncate
+    values = np.asarray(mor)
+    if values.dtype == np.int8:
+        return values
+    cast = values.astype(np.int8)
+    if not np.array_equal(cast, values):
+        raise ValueError('mode of regulation values must be integers between -128 and 127')
+    return cast
+
+
+def compact_from_dict(network):
+    src_ids = sorted(network.keys())
+    trg_ids = sorted(set(k for d in network.values() for k in d.keys()))
+    trg_idx = {k: i for i, k in enumerate(trg_ids)}
+
+    src, trg, mor = [], [], []
+    for i, s in enumerate(src_ids):
+        targets = sorted(network[s].items(), key=lambda kv: trg_idx[kv[0]])
+        src.extend([i] * len(targets))
+        trg.extend(trg_idx[k] for k, _ in targets)
+        mor.extend(v for _, v in targets)
+
+    return CompactNetwork(src_ids, trg_ids,
+                          np.array(src, dtype=np.int32),
+                          np.array(trg, dtype=np.int32),
+                          _mor_array(mor))
+
+
+def compact_from_edges(src, trg, mor):
+    # vectorized construction from an edge list. As when building the nested
+    # dict, the last of repeated (src, trg) pairs wins
+    src = np.asarray(src, dtype=str)
+    trg = np.asarray(trg, dtype=str)
+    mor = _mor_array(mor)
+
+    # sorted unique ids, and the id index of every edge
+    src_ids, src_codes = np.unique(src, return_inverse=True)
+    trg_ids, trg_codes = np.unique(trg, return_inverse=True)
+
+    # lexsort is stable, repeated pairs stay in their original order
+    order = np.lexsort((trg_codes, src_codes))
+    s, t = src_codes[order], trg_codes[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (s[1:] != s[:-1]) | (t[1:] != t[:-1])
+    order = order[last]
+
+    return CompactNetwork(src_ids.tolist(), trg_ids.tolist(),
+                          src_codes[order].astype(np.int32),
+                          trg_codes[order].astype(np.int32),
+                          mor[order])
+
+
+def compact_to_dict(net):
+    network = {}
+    # edges are sorted by src, so each tf owns a contiguous slice
+    bounds = np.searchsorted(net.src, np.arange(len(net.src_ids) + 1))
+    trg_ids = np.array(net.trg_ids, dtype=object)
+    for i, s in enumerate(net.src_ids):
+        a, b = bounds[i], bounds[i+1]
+        network[s] = dict(zip(trg_ids[net.trg[a:b]], net.mor[a:b].tolist()))
+
+    return network
+
+
+def encode_network(net):
+    if isinstance(net, dict):
+        net = compact_from_dict(net)
+
+    header = json.dumps({'src_ids': list(net.src_ids), 'trg_ids': list(net.trg_ids)}).encode()
+    body = b''.join([
+        struct.pack('<I', len(header)), header,
+        np.ascontiguousarray(net.src, dtype='<i4').tobytes(),
+        np.ascontiguousarray(net.trg, dtype='<i4').tobytes(),
+        np.ascontiguousarray(_mor_array(net.mor), dtype='i1').tobytes(), ])
+
+    return MAGIC + zlib.compress(body, 6)
+
+
+def decode_network(filebytes):
+    if not filebytes.startswith(MAGIC):
+        raise ValueError('not an encoded network')
+
+    body = zlib.decompress(filebytes[len(MAGIC):])
+    header_len, = struct.unpack_from('<I', body)
+    offset = 4 + header_len
+    header = json.loads(body[4:offset])
+
+    n_edges = (len(body) - offset) // 9
+    src = np.frombuffer(body, dtype='<i4', count=n_edges, offset=offset)
+    trg = np.frombuffer(body, dtype='<i4', count=n_edges, offset=offset + 4 * n_edges)
+    mor = np.frombuffer(body, dtype='i1', count=n_edges, offset=offset + 8 * n_edges)
+
+    return CompactNetwork(header['src_ids'], header['trg_ids'], src, trg, mor)
+
+
+def is_encoded_network(filebytes):
+    return filebytes.startswith(MAGIC)
@@ -1,25 +1,26 @@
-import os
-import json
 import datetime
+from hashlib import sha256
 from pprint import pprint
 
 import numpy as np
 import pandas as pd
-import plotly.express as px
+import plotly.graph_objects as go
 
 import dash_bootstrap_components as dbc
 from dash import callback_context as ctx
 from dash.exceptions import PreventUpdate
 from dash.dependencies import Input, Output, State, MATCH, ALL
-from dash import dcc, html, dash_table
-from app import app
+from dash import html, dash_table, Patch, no_update
+from app import app, url_base_pathname
 
 from global_helper_functions import get_networks
-from .helper_functions import parse_contents, load_json_file
-from .helper_functions import submit_job, get_job_status
-
-
-networks = get_networks()
+from upload_store import save_upload
+from network_codec import compact_from_edges
+from .helper_functions import parse_contents, get_result_table
+from .helper_functions import submit_job, get_job_status, progress_retry_after
+from .helper_functions import register_network, register_catalog_network
+from .helper_functions import get_evidence_table, get_de_values, get_de_table, decimate_points
+from .helper_functions import table_page, get_upload_table
 
 
 @app.callback(
@@ -35,7 +36,7 @@ def populate_network_net_source_dropdown(use_predefined):
         options = []
         value = None
     else:
-        options_lst = list(networks.keys())
+        options_lst = list(get_networks().keys())
         options_lst.sort()
         options = [{'label': ' '.join(map(str.capitalize, k.split('_'))), 'value': k} for k in options_lst]
         value = 'gtex_chip'
@@ -52,7 +53,7 @@ def populate_network_net_organism_dropdown(net_source):
         options = []
         value = None
     else:
-        options_lst = list(networks[net_source].keys())
+        options_lst = list(get_networks(net_source)[net_source].keys())
         options_lst.sort()
         options = [{'label': ' '.join(map(str.capitalize, k.split('_'))), 'value': k} for k in options_lst]
         value = 'homo_sapiens' if 'homo_sapiens' in options_lst else (options[0]['value'] if options else None)
@@ -70,7 +71,7 @@ def populate_network_ntype_dropdown(net_source, net_organism):
         options = []
         value = None
     else:
-        options_lst = list(networks[net_source][net_organism].keys())
+        options_lst = list(get_networks(net_source, net_organism)[net_source][net_organism].keys())
         options_lst.sort()
         options = [{'label': ' '.join(map(str.capitalize, k.split('_'))), 'value': k} for k in options_lst]
         value = 'tissue_independent' if 'tissue_independent' in options_lst else (options[0]['value'] if options else None)
@@ -89,7 +90,7 @@ def populate_network_name_dropdown(net_source, net_organism, ntype):
         options = []
         value = None
     else:
-        options_lst = list(networks[net_source][net_organism][ntype].keys())
+        options_lst = list(get_networks(net_source, net_organism, ntype)[net_source][net_organism][ntype].keys())
         options_lst.sort()
         options = [{'label': ' '.join(map(str.capitalize, k.replace('.rels', '').split('_'))), 'value': k} for k in options_lst]
         value = 'three_tissue.rels' if 'three_tissue.rels' in options_lst else (options[0]['value'] if options else None)
@@ -105,9 +106,8 @@ def update_network_selected(nids, netsel):
     ns = {i['key']:v for i, v in zip(nids, netsel)}
     if all([bool(v) for v in netsel]):
         s, o, t, n = ns['net_source'], ns['net_organism'], ns['ntype'], ns['name']
-        network_file = networks[s][o][t][n]
-        with open(network_file, 'r') as file:
-            return json.load(file)
+        network_file = get_networks(s, o, t)[s][o][t][n]
+        return register_catalog_network(network_file)
 
     raise PreventUpdate
 
@@ -168,19 +168,26 @@ def update_network_upload(content, filename, date):
         network[gcn['trg']] = network[gcn['trg']].astype(str)
         network[gcn['mor']] = network[gcn['mor']].apply(np.sign).astype(int)
 
-        dff = network.set_index([gcn['src'], gcn['trg']])
-        dff = dff.groupby(level=0).apply(lambda df: df.xs(df.name)[gcn['mor']].to_dict())
-        network = dff.to_dict()
+        network = compact_from_edges(network[gcn['src']].to_numpy(),
+                                     network[gcn['trg']].to_numpy(),
+                                     network[gcn['mor']].to_numpy())
 
-    n_src = len(network.keys())
-    n_trg = len(set([k for d in network.values() for k in d.keys()]))
-    n_rel = sum([len(d) for d in network.values()])
+    # the network stays on the server, the store only gets its hash and stats
+    try:
+        summary = register_network(network)
+    except ValueError as e:
+        # e.g. weighted edges, mode of regulation values must be integers
+        droparea_text = html.Div([
+            f'Loaded data: {filename}', html.Br(),
+            f'Error: {e}',
+        ])
+        return {}, droparea_text
     droparea_text = html.Div([
         f'Loaded data: {filename}', html.Br(),
-        f"{n_src} tfs, {n_trg} genes, {n_rel} edges"
+        f"{summary['n_src']} tfs, {summary['n_trg']} genes, {summary['n_edges']} edges"
     ])
     
-    return network, droparea_text
+    return summary, droparea_text
 
 
 @app.callback(
@@ -194,23 +201,23 @@ def update_network_upload(content, filename, date):
 def update_output(content, filename, date):
     if content is not None:
         df = parse_contents(content, filename)
-        if df is not None:
-            table = html.Div([
-                html.H5(filename),
-                html.H6(datetime.datetime.fromtimestamp(date)),
-
-                dash_table.DataTable(
-                    df.iloc[:50].to_dict('records'),
-                    [{'name': i, 'id': i} for i in df.columns],
-                    page_size=5,
-                ),
-            ])
-        else:
+        if df is None:
             table = html.Div(['There was an error processing this file.'])
+            return table, html.Div([f'Failed to load: {filename}']), [], {}
+
+        # the table stays on the server, the store only gets its key and
+        # columns. The preview pages through it
+        upload = save_upload(df, sha256(content.encode()).hexdigest())
+        table = html.Div([
+            html.H5(filename),
+            html.H6(datetime.datetime.fromtimestamp(date)),
+            paged_table('input-data-table', upload['columns'], page_size=5),
+        ])
 
         nrows = df.shape[0]
         droparea_text = html.Div([ f'Loaded data: {filename} ({nrows} rows)'])
-        return table, droparea_text, df.columns.to_list(), df.to_dict()
+
+        return table, droparea_text, upload['columns'], upload
     else:
         raise PreventUpdate
 
@@ -268,8 +275,71 @@ def guess_columns(id, cols):
     return options, value
 
 
+def volcano_de_trace_data(df, plot_y, de, value):
+    rows = de == value
+    return {'x': df['Log2FC'].to_numpy()[rows], 'y': df[plot_y].to_numpy()[rows], 'text': df['Gene'].to_numpy()[rows]}
+
+
+def volcano_figure(df, plot_y, de):
+    # WebGL traces. Every gene is drawn in gray, decimated when there are
+    # many, and the DE genes on top of them, in full. A threshold change only
+    # needs to replace the two DE traces
+    keep = decimate_points(df['Log2FC'].to_numpy(), df[plot_y].to_numpy())
+    background = df.iloc[keep]
+
+    hovertemplate = '%{text}<br>Log2FC: %{x:.3f}<br>' + plot_y + ': %{y:.3f}<extra></extra>'
+    fig = go.Figure([
+        go.Scattergl(x=background['Log2FC'], y=background[plot_y], text=background['Gene'],
+                     mode='markers', marker_color='lightgray', name='', hovertemplate=hovertemplate),
+        go.Scattergl(**volcano_de_trace_data(df, plot_y, de, -1),
+                     mode='markers', marker_color='blue', name='down', hovertemplate=hovertemplate),
+        go.Scattergl(**volcano_de_trace_data(df, plot_y, de, 1),
+                     mode='markers', marker_color='red', name='up', hovertemplate=hovertemplate),
+    ])
+    fig.update_layout(xaxis_range=[-4,4], xaxis_title='Log2FC', yaxis_title=plot_y, legend_title='evidence')
+    return fig
+
+
+def volcano_patch(df, plot_y, de):
+    patch = Patch()
+    for i, value in [(1, -1), (2, 1)]:
+        for k, v in volcano_de_trace_data(df, plot_y, de, value).items():
+            patch['data'][i][k] = v
+    return patch
+
+
+def evidence_columns(cids, colnames):
+    # (standard name, uploaded column) pairs of the columns to use, or None
+    # when the gene or log2fc column was not chosen
+    t = {i['key']:c for i, c in zip(cids, colnames) if c != 'not-available'}
+    if 'gene' not in t.keys() or 'logfc' not in t.keys():
+        return None
+
+    keys = ['gene', 'pval', 'logfc']
+    std_names = ['Gene', 'P-Value', 'Log2FC']
+    return tuple((s, t[k]) for k, s in zip(keys, std_names) if k in t.keys())
+
+
+def paged_table(table_id, columns, page_size):
+    # only the current page is sent, a callback fills it from the server side
+    # table, which it filters and sorts as the user asks
+    return dash_table.DataTable(
+        id=table_id,
+        columns=[{'name': c, 'id': c} for c in columns],
+        page_current=0,
+        page_size=page_size,
+        page_action='custom',
+        sort_action='custom',
+        sort_mode='multi',
+        sort_by=[],
+        filter_action='custom',
+        filter_query='',
+    )
+
+
 @app.callback(
-    Output('volcano-plot', 'children'),
+    Output('volcano-plot-graph', 'figure'),
+    Output('volcano-plot', 'style'),
     Output('selected-evidence-final', 'data'),
     Output('processed-data-table', 'children'),
     Output('final-evidence-info', 'children'),
@@ -286,80 +356,40 @@ def process_input_data(data, cids, colnames, network, logfc_threshold, p_val_thr
     except TypeError:
         raise PreventUpdate
 
+    no_plot = {}, {'display': 'none'}
     if not data or len(data) == 0:
-        return None, {}, None, None
+        return *no_plot, {}, None, None
 
     if not network or len(network) == 0:
-        return None, {}, None, None
+        return *no_plot, {}, None, None
 
-    # determine tfs and genes available in the network
-    # we will filter out genes not available
-    # src_set = set(network.keys())
-    trg_set = set([k for d in network.values() for k in d.keys()])
-    # n_edges = sum([len(d.values()) for d in network.values()])
+    columns = evidence_columns(cids, colnames)
+    if columns is None:
+        return *no_plot, {}, None, None
 
-    # this is a map specifying the columns to use
-    t = {i['key']:c for i, c in zip(cids, colnames) if c != 'not-available'}
-    if 'gene' not in t.keys() or 'logfc' not in t.keys():
-        return None, {}, None, None
+    # stage 1: the cleaned table, computed once per upload, columns and network
+    try:
+        df = get_evidence_table(data['key'], columns, network['network_hash'])
+    except FileNotFoundError:
+        # the upload expired from the server side store
+        return *no_plot, {}, None, None
 
-    keys = ['gene', 'pval', 'logfc']
-    std_names = ['Gene', 'P-Value', 'Log2FC']
-    orig_names_avail = []
-    std_names_avail = []
-    for k, s in zip(keys, std_names):
-        if k in t.keys():
-            orig_names_avail.append(t[k])
-            std_names_avail.append(s)
-
-    # we build the dataframe and select only the columns of interest
-    # then change the column names to the standard names we can work with
-    df = pd.DataFrame(data)
-    df = df.loc[:, orig_names_avail]
-    df.columns = std_names_avail
-
-    # determine which genes were differentially expressed according to 
+    # stage 2: determine which genes were differentially expressed according to
     # logfc and pvalue thresholds
-    logfc_filter = lambda x: 1 if x >= logfc_threshold else (-1 if x <= -logfc_threshold else 0)
-    df['DE value'] = df['Log2FC'].apply(logfc_filter)
-
-    if 'pval' in t.keys():
-        # filter by pvalue
-        df['DE value'] *= (df['P-Value'] < p_val_threshold).astype(int)
-
-        # generate a series to show in volcano plot
-        plot_y = '-log10(P-Value)'
-        df[plot_y] = -np.log10(df['P-Value']+np.finfo(float).eps)
-
-        df = df.sort_values('P-Value')
+    de = get_de_values(df, logfc_threshold, p_val_threshold)
+
+    # stage 3: the views
+    plot_y = '-log10(P-Value)' if 'P-Value' in dict(columns) else 'abs(log2FC)'
+    # when only the thresholds changed, the plot already shows this table and
+    # just the DE genes are sent again
+    triggered = set(tr['prop_id'] for tr in ctx.triggered)
+    if triggered.issubset({'logfc-threshold.value', 'pval-threshold.value'}):
+        fig = volcano_patch(df, plot_y, de)
     else:
-        # generate a series to show in volcano plot
-        plot_y = 'abs(log2FC)'
-        df[plot_y] = np.abs(df['Log2FC'])
-
-        # if no pvalue is available, we sort by abs(log2fc)
-        # create a dummy column for pvalue
-        df['P-Value'] = 0.
-        df = df.sort_values('abs(log2FC)', ascending=False)
-
-    # eliminate duplicated genes, keeping the most significant result
-    # according to pvalue (or abs(log2fc))
-    df = df.drop_duplicates('Gene').dropna()
-    if df.Gene.dtype == float:
-        df['Gene'] = df['Gene'].astype(int)
-    df['Gene'] = df['Gene'].astype(str)
-
-    # keep only genes available in the network
-    df = df.loc[df['Gene'].isin(trg_set)]
-
-    evidence_map = {-1: 'down', 0:'', 1: 'up'}
-    df['evidence'] = df['DE value'].map(evidence_map)
-    color_map = {'down': 'blue', '': 'lightgray', 'up': 'red'}
-    fig = px.scatter(df, x='Log2FC', y=plot_y, color='evidence', color_discrete_map=color_map)
-    fig.update_layout(xaxis_range=[-4,4])
-
-    df = df.loc[df['DE value'] != 0]
-    evidence = df.set_index('Gene')['DE value'].to_dict()
+        fig = volcano_figure(df, plot_y, de)
+
+    df = get_de_table(data['key'], columns, network['network_hash'], logfc_threshold, p_val_threshold)
+    evidence = dict(zip(df['Gene'], df['DE value'].tolist()))
 
     n_deg = len(evidence)
     # final_evidence_info = dbc.Alert(f'There are {n_deg} DE genes selected', color='success')
@@ -371,9 +401,8 @@ def process_input_data(data, cids, colnames, network, logfc_threshold, p_val_thr
         text_color='primary',
         className="border me-1 float-end",
     )
-    dt_data = df.iloc[:50].to_dict('records')
-    dt_columns = [{'name': i, 'id': i} for i in df.columns]
-    return dcc.Graph(figure=fig), evidence, dash_table.DataTable(dt_data, dt_columns, page_size=5), final_evidence_info
+    table = paged_table('evidence-table', df.columns, page_size=5)
+    return fig, {'display': 'block'}, evidence, table, final_evidence_info
 
 
 @app.callback(
@@ -386,11 +415,12 @@ def submit_inference_job(button_click, network, evidence):
 
     button_clicked = ctx.triggered[0]['prop_id'] == 'submit-job-button.n_clicks'
     if button_clicked:
-        job_id, task_id, data = submit_job(network, evidence)
+        job_id, task_id, data = submit_job(network['network_hash'], evidence)
         return {
             'job_id': job_id,
             'task_id': task_id,
-            # 'data': data,
+            # set when an identical job had already finished
+            'posterior_hash': data.get('posterior_hash'),
         }
     
 
@@ -399,23 +429,41 @@ def submit_inference_job(button_click, network, evidence):
     Output('inference-progress-timer', 'disabled'),
     Output('output-data', 'data'),
     Output('inference-result-download-button', 'style'),
+    Output({'type': 'inference-result-download', 'format': ALL}, 'href'),
     Input('queue-task-info', 'data'),
+    Input('job-progress', 'data'),
     Input('inference-progress-timer', 'n_intervals'),
     State({'type': 'net-select', 'key': 'net_organism'}, 'value'),
+    State({'type': 'inference-result-download', 'format': ALL}, 'id'),
 )
-def update_job_status(info, refresh_trigger, organism):
+def update_job_status(info, pushed, refresh_trigger, organism, download_ids):
     if info is None:
         raise PreventUpdate
 
-    disable_interval = False
+    # the timer is left as the event stream set it until the job is done
+    disable_interval = no_update
 
     job_id = info['job_id']
     task_id = info['task_id']
     posterior_hash = None
 
-    meta = get_job_status(task_id)
+    triggered = set(tr['prop_id'] for tr in ctx.triggered)
+    if info.get('posterior_hash') is not None:
+        # cached result, the task may be long gone from the result backend
+        meta = {'status': 'SUCCESS', 'result': {'posterior_hash': info['posterior_hash'], 'meta': {}}}
+    elif 'job-progress.data' in triggered and pushed and pushed.get('task_id') == task_id:
+        # pushed by the server, no need to ask the result backend
+        meta = pushed
+    elif 'job-progress.data' in triggered:
+        # an update of a previous job
+        raise PreventUpdate
+    else:
+        meta = get_job_status(task_id)
     status = meta.get('status', 'PENDING')
     meta = meta.get('result')
+    # the result of a failed task is its error, not a dict
+    if not isinstance(meta, dict):
+        meta = None
     if meta is not None:
         if 'meta' in meta.keys():
             posterior_hash = meta.get('posterior_hash')
@@ -434,49 +482,144 @@ def update_job_status(info, refresh_trigger, organism):
                  f"N Sampled: {n_sampled}", html.Br(),
                  f"Gelman-Rubin Statistic: {gr_stat:.4f}", html.Br(), ]
 
+    # jobs sampled with parallel chains report the progress of each one
+    for i, chain in enumerate(meta.get('chains', []) if meta is not None else []):
+        children.extend([
+            f"Chain {i+1}: {chain['state']}, {chain['n_sampled']} sampled, "
+            f"Gelman-Rubin {chain['gr_stat']:.4f}", html.Br(), ])
+
     if posterior_hash is not None:
-        posterior = load_json_file(posterior_hash)
-        annotation_filepath = os.path.join("assets", "data", "annotations", organism, "ncbi", "symbol.json")
-        if os.path.exists(annotation_filepath):
-            with open(annotation_filepath) as file:
-                annotation = json.load(file)
-        else:
-            annotation = {}
-
-        posterior_df = pd.DataFrame(posterior).reset_index().sort_values('X', ascending=False)
-        posterior_df.columns = ['TF', 'X', 'T']
-        if len(set(posterior_df['TF']).intersection(annotation.keys())) > 0:
-            posterior_df['symbol'] = posterior_df['TF'].map(annotation)
-            posterior_df = posterior_df.iloc[:, [0, 3, 1, 2]]
-
-        dt_data = posterior_df.to_dict('records')
-        dt_columns = [{'name': i, 'id': i} for i in posterior_df.columns]
-        dt_table = dash_table.DataTable(dt_data, dt_columns, page_size=25)
-        children.append(dt_table)
+        posterior_df = get_result_table(posterior_hash, organism)
+        # the store only gets what identifies the result, the table pages
+        # through the cached frame
+        result = {'posterior_hash': posterior_hash, 'organism': organism}
+        children.append(paged_table('inference-result-table', posterior_df.columns, page_size=25))
         disable_interval = True
         download_button_style = {'display': 'block'}
+        # served by the download endpoint, straight from the store
+        download_hrefs = [f"{url_base_pathname}results/{posterior_hash}?format={i['format']}&organism={organism or ''}"
+                          for i in download_ids]
     else:
         download_button_style = {'display': 'none'}
-        dt_data = None
+        download_hrefs = [no_update] * len(download_ids)
+        result = None
+        if status in ['FAILURE', 'REVOKED']:
+            disable_interval = True
+
+    return html.Div(children), disable_interval, result, download_button_style, download_hrefs
+
 
-    return html.Div(children), disable_interval, dt_data, download_button_style
+def page_inputs(table_id):
+    return [Input(table_id, 'page_current'),
+            Input(table_id, 'page_size'),
+            Input(table_id, 'sort_by'),
+            Input(table_id, 'filter_query'), ]
 
 
 @app.callback(
-        Output('inference-result-download', 'data'),
-        Input('inference-result-download-button', 'n_clicks'),
-        State('output-data', 'data'),
-)
-def download_output_data(_, dt_data):
-    if ctx.triggered[0]['prop_id'] != 'inference-result-download-button.n_clicks':
+    Output('input-data-table', 'data'),
+    Output('input-data-table', 'page_count'),
+    *page_inputs('input-data-table'),
+    State('input-data', 'data'),)
+def update_input_data_page(page_current, page_size, sort_by, filter_query, data):
+    if not data:
         raise PreventUpdate
 
-    if not dt_data:
+    try:
+        df = get_upload_table(data['key'], tuple(data['columns']))
+    except FileNotFoundError:
+        raise PreventUpdate
+
+    return table_page(df, page_current, page_size, sort_by, filter_query)
+
+
+@app.callback(
+    Output('evidence-table', 'data'),
+    Output('evidence-table', 'page_count'),
+    *page_inputs('evidence-table'),
+    State('input-data', 'data'),
+    State({'type': 'data-column-role', 'key': ALL}, 'id'),
+    State({'type': 'data-column-role', 'key': ALL}, 'value'),
+    State('selected-network-final', 'data'),
+    State('logfc-threshold', 'value'),
+    State('pval-threshold', 'value'), )
+def update_evidence_page(page_current, page_size, sort_by, filter_query,
+                         data, cids, colnames, network, logfc_threshold, p_val_threshold):
+    columns = evidence_columns(cids, colnames)
+    if not data or not network or columns is None:
+        raise PreventUpdate
+
+    try:
+        df = get_de_table(data['key'], columns, network['network_hash'],
+                          float(logfc_threshold), float(p_val_threshold))
+    except (FileNotFoundError, TypeError):
         raise PreventUpdate
-    
-    df = pd.DataFrame(dt_data)
 
-    return dict(content=df.to_csv(sep='\t', index=False), filename="inference_result.tsv")
+    return table_page(df, page_current, page_size, sort_by, filter_query)
+
+
+@app.callback(
+    Output('inference-result-table', 'data'),
+    Output('inference-result-table', 'page_count'),
+    *page_inputs('inference-result-table'),
+    State('output-data', 'data'),)
+def update_result_page(page_current, page_size, sort_by, filter_query, result):
+    if not result:
+        raise PreventUpdate
+
+    df = get_result_table(result['posterior_hash'], result['organism'])
+    return table_page(df, page_current, page_size, sort_by, filter_query)
+
+
+# opens a server-sent events stream for the submitted job. Each update is
+# written to job-progress, which triggers update_job_status. If the stream
+# can't be opened, or the server closes it for good, the timer polls instead
+# and a new stream is tried after a while, e.g. once the server has room
+app.clientside_callback(
+    """
+    function follow_job_progress(info) {
+        if (window.nlbProgressSource) {
+            window.nlbProgressSource.close();
+            window.nlbProgressSource = null;
+        }
+        if (window.nlbProgressRetry) {
+            clearTimeout(window.nlbProgressRetry);
+            window.nlbProgressRetry = null;
+        }
+        if (!info || info.posterior_hash || typeof(EventSource) === 'undefined') {
+            return !info || !!info.posterior_hash;
+        }
+
+        const done = ['SUCCESS', 'FAILURE', 'REVOKED'];
+        const open = function() {
+            const source = new EventSource('URL_BASE_PATHNAME' + 'progress/' + encodeURIComponent(info.task_id));
+            source.onopen = function(e) {
+                dash_clientside.set_props('inference-progress-timer', {disabled: true});
+            };
+            source.onmessage = function(e) {
+                const meta = JSON.parse(e.data);
+                meta.task_id = info.task_id;
+                dash_clientside.set_props('job-progress', {data: meta});
+                if (done.includes(meta.status)) source.close();
+            };
+            source.onerror = function(e) {
+                // a dropped connection is retried by the browser, a refused one isn't.
+                // Spread out, so refused browsers don't all come back at once
+                if (source.readyState === EventSource.CLOSED) {
+                    dash_clientside.set_props('inference-progress-timer', {disabled: false});
+                    window.nlbProgressRetry = setTimeout(open, RETRY_MS * (1 + Math.random()));
+                }
+            };
+            window.nlbProgressSource = source;
+        };
+        open();
+        return true;
+    }
+    """.replace('URL_BASE_PATHNAME', url_base_pathname).replace('RETRY_MS', str(int(progress_retry_after * 1000))),
+    Output('inference-progress-timer', 'disabled', allow_duplicate=True),
+    Input('queue-task-info', 'data'),
+    prevent_initial_call=True,
+)
 
 
 app.clientside_callback(
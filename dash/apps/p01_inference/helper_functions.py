@@ -1,59 +1,154 @@
 import os
 import io
+import csv
+import bz2
+import gzip
 import json
 import base64
+from uuid import uuid4
 from datetime import datetime
+from functools import lru_cache
 from hashlib import sha256
 from glob import glob
+from collections import namedtuple
 
+import numpy as np
 import pandas as pd
 
-import gridfs
-from pymongo import MongoClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from bson.objectid import ObjectId
 from celery import Celery
 import celery
+from kombu import Queue
+
+# optional: zstd compressed uploads, and a faster multithreaded csv parser
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    csv_engine = 'pyarrow'
+except ImportError:
+    csv_engine = 'c'
+
+from network_codec import encode_network, decode_network, compact_from_dict
+from network_catalog import get_catalog_entry, load_cached_network
+from upload_store import load_columns
+from data_access import get_fs, get_jobs
 
 
 broker = os.environ['NLB_QUEUE_BROKER']
 backend = os.environ['NLB_QUEUE_BACKEND']
-mongo_url = os.environ['NLB_DATA_STORE']
 worker = Celery('nlbayes_jobs', backend=backend, broker=broker)
+# number of decoded networks kept in memory by each dash process
+network_cache_size = int(os.environ.get('NLB_NETWORK_CACHE_SIZE', 8))
+# number of cleaned evidence tables kept in memory by each dash process
+evidence_cache_size = int(os.environ.get('NLB_EVIDENCE_CACHE_SIZE', 16))
+# number of uploaded tables kept in memory by each dash process, for paging
+# through their preview
+preview_cache_size = int(os.environ.get('NLB_PREVIEW_CACHE_SIZE', 8))
+# number of decoded posteriors, and of organism annotations, kept in memory by
+# each dash process
+posterior_cache_size = int(os.environ.get('NLB_POSTERIOR_CACHE_SIZE', 64))
+annotation_cache_size = int(os.environ.get('NLB_ANNOTATION_CACHE_SIZE', 4))
+# volcano plots with more points than this get their background decimated
+volcano_max_points = int(os.environ.get('NLB_VOLCANO_MAX_POINTS', 5000))
+
+# jobs are routed by their estimated cost to a queue for small, interactive
+# jobs or one for large jobs, each served by its own pool of workers. The
+# queue declarations must match the ones in the worker
+large_job_cost = float(os.environ.get('NLB_LARGE_JOB_COST', 200000))
+job_queues = {'small': 'ornor_small', 'large': 'ornor_large'}
+worker.conf.task_queues = [Queue(q, queue_arguments={'x-max-priority': 9}) for q in job_queues.values()]
+
+
+def estimate_job_cost(n_edges, n_evidence, n_jobs=1):
+    # sampling time grows with the number of edges updated per sample. Evidence
+    # genes add likelihood terms on top of that
+    return n_jobs * (n_edges + 4 * n_evidence)
+
+
+def route_job(cost):
+    # returns the queue and the priority within it, cheaper jobs go first
+    size = 'large' if cost >= large_job_cost else 'small'
+    priority = 9 - min(9, int(9 * cost / large_job_cost)) if size == 'small' else 0
+    return job_queues[size], priority
+
+
+compressed_extensions = {'.gz': 'gzip', '.bz2': 'bz2', '.zst': 'zstd'}
+compression_magic = {b'\x1f\x8b': 'gzip', b'BZh': 'bz2', b'\x28\xb5\x2f\xfd': 'zstd'}
+
+
+def open_upload(decoded):
+    # a binary stream over the uploaded bytes, decompressing on the fly. The
+    # compression is recognized from the content, not the filename
+    stream = io.BytesIO(decoded)
+    for magic, compression in compression_magic.items():
+        if decoded[:len(magic)] == magic:
+            break
+    else:
+        return stream
+
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=stream)
+    if compression == 'bz2':
+        return bz2.BZ2File(stream)
+    if zstandard is None:
+        raise ValueError('zstd compressed files need the zstandard package')
+    return zstandard.ZstdDecompressor().stream_reader(stream)
+
+
+def sniff_separator(head, default):
+    # compare tabs and commas over the first complete lines only. Lines are
+    # split as csv, so separators inside quoted fields are not counted. On a
+    # tie the extension's separator wins
+    lines = head.split(b'\n')
+    lines = lines[:-1] if len(lines) > 1 else lines
+    text = b'\n'.join(lines[:20]).decode('utf-8', errors='replace')
+
+    counts = {}
+    for sep in ['\t', ',']:
+        try:
+            counts[sep] = sum(len(row) - 1 for row in csv.reader(io.StringIO(text), delimiter=sep))
+        except csv.Error:
+            counts[sep] = 0
+
+    other = ',' if default == '\t' else '\t'
+    return other if counts[other] > counts[default] else default
 
 
 def parse_contents(contents:str, filename: str):
-    content_type, content_string = contents.split(',')
+    content_string = contents[contents.index(',') + 1:]
 
     decoded = base64.b64decode(content_string)
+    del content_string
+
+    name = filename.lower()
+    root, ext = os.path.splitext(name)
+    if ext in compressed_extensions:
+        name = root
+
     try:
-        if filename.lower().endswith('.csv'):
-            content = decoded.decode('utf-8')
-            if content.count(',') == 0:
-                # check if it is a tsv instead
-                if content.count('\t') > 0:
-                    sep = '\t'
-            else:
-                sep = ','
-            # Assume that the user uploaded a CSV file
-            return pd.read_csv(io.StringIO(content), sep=sep)
-
-        elif filename.lower().endswith('.tsv'):
-            content = decoded.decode('utf-8')
-            if content.count('\t') == 0:
-                # check if it is a csv instead
-                if content.count(',') > 0:
-                    sep = ','
-            else:
-                sep = '\t'
-            # Assume that the user uploaded a TSV file
-            return pd.read_csv(io.StringIO(content), sep=sep)
-
-        elif filename.lower().endswith('.xlsx') or filename.lower().endswith('.xls'):
+        if name.endswith('.csv') or name.endswith('.tsv'):
+            # the separator is guessed from a small sample at the start of the
+            # file. Either extension may hold the other kind of table
+            with open_upload(decoded) as stream:
+                head = stream.read(64 * 1024)
+            sep = sniff_separator(head, ',' if name.endswith('.csv') else '\t')
+
+            with open_upload(decoded) as stream:
+                return pd.read_csv(stream, sep=sep, engine=csv_engine)
+
+        elif name.endswith('.xlsx') or name.endswith('.xls'):
             # Assume that the user uploaded an excel file
-            return pd.read_excel(io.BytesIO(decoded))
+            return pd.read_excel(open_upload(decoded))
 
-        elif filename.lower().endswith('.json'):
-            return json.loads(decoded)
+        elif name.endswith('.json'):
+            with open_upload(decoded) as stream:
+                return json.load(stream)
 
     except Exception as e:
         print(e, flush=True)
@@ -63,69 +158,458 @@ def parse_contents(contents:str, filename: str):
     return None
 
 
-class NLBayesFS:
-    def __init__(self, mongo_client) -> None:
-        gfs_db = mongo_client.nlbayes_gfs_db
-        self.gfs = gridfs.GridFS(gfs_db)
+# Networks are kept server side, in GridFS, under their content hash. The
+# browser stores only hold the summary returned by `register_network`, and
+# callbacks resolve the hash through the in-process cache of `get_network`
+def network_summary(network_hash, net):
+    return { 'network_hash': network_hash,
+             'n_src': len(net.src_ids),
+             'n_trg': len(net.trg_ids),
+             'n_edges': len(net.mor), }
+
+
+def register_network(network):
+    if isinstance(network, dict):
+        network = compact_from_dict(network)
+
+    network_hash = get_fs().save_network(network)
+
+    return network_summary(network_hash, network)
+
+
+def register_catalog_network(network_file):
+    # predefined networks are indexed by the catalog, which knows their hash
+    # and stats. They only need to be copied to GridFS, once, for the workers
+    entry = get_catalog_entry(network_file)
+    _store_catalog_network(entry['hash'], network_file)
+
+    return { 'network_hash': entry['hash'],
+             'n_src': entry['n_src'],
+             'n_trg': entry['n_trg'],
+             'n_edges': entry['n_edges'], }
+
+
+@lru_cache(maxsize=None)
+def _store_catalog_network(network_hash, network_file):
+    filebytes = load_cached_network(network_hash)
+    if filebytes is None:
+        with open(network_file, 'r') as file:
+            filebytes = encode_network(json.load(file))
+    get_fs().save_file(filebytes, 'network.nlbnet')
+
+
+@lru_cache(maxsize=network_cache_size)
+def get_network(network_hash):
+    filebytes = load_cached_network(network_hash)
+    if filebytes is not None:
+        return decode_network(filebytes)
+
+    content, filename = get_fs().load_file(network_hash)
+
+    if filename.endswith('.json'):
+        return compact_from_dict(json.loads(content))
+    return decode_network(content)
 
-    def save_file(self, filebytes, filename):
-        hash = sha256(filebytes).hexdigest()
 
-        if not self.gfs.exists(_id=hash):
-            self.gfs.put(filebytes, _id=hash, filename=filename)
+# lookups derived from a network that evidence processing needs over and over.
+# The pandas indexes build their hash tables once, then each lookup against
+# them costs O(evidence) instead of O(edges)
+NetworkIndex = namedtuple('NetworkIndex', ['tfs', 'targets', 'tf_index', 'trg_index'])
+
+
+@lru_cache(maxsize=network_cache_size)
+def get_network_index(network_hash):
+    net = get_network(network_hash)
+    return NetworkIndex(tfs=list(net.src_ids),
+                        targets=frozenset(net.trg_ids),
+                        tf_index=pd.Index(net.src_ids),
+                        trg_index=pd.Index(net.trg_ids))
+
+
+def get_target_rows(network_hash, genes):
+    # position of each gene among the network targets, -1 if it isn't one
+    return get_network_index(network_hash).trg_index.get_indexer(genes)
+
+
+@lru_cache(maxsize=preview_cache_size)
+def get_upload_table(upload_key, columns):
+    # every column of an upload, for its preview. Uploads never change under
+    # their key. Shared by callers, it must not be modified
+    return load_columns(upload_key, list(columns))
+
+
+# Evidence processing runs in stages. The cleaned table only depends on the
+# upload, the column choice and the network, so it is cached on those. The
+# thresholds are applied to it afterwards, vectorized, on every change
+@lru_cache(maxsize=evidence_cache_size)
+def get_evidence_table(upload_key, columns, network_hash):
+    # columns is a tuple of (standard name, uploaded column name) pairs.
+    # Only those columns are read from the stored upload
+    data = load_columns(upload_key, [orig for _, orig in columns])
+    data.columns = [std for std, _ in columns]
+    return build_evidence_table(data, network_hash)
+
+
+def build_evidence_table(df, network_hash):
+    # df holds only the columns of interest, with the standard names
+    # 'Gene', 'Log2FC' and, when available, 'P-Value'
+    df = df.copy()
+    df['Log2FC'] = pd.to_numeric(df['Log2FC'], errors='coerce')
+
+    if 'P-Value' in df.columns:
+        # generate a series to show in volcano plot
+        df['P-Value'] = pd.to_numeric(df['P-Value'], errors='coerce')
+        df['-log10(P-Value)'] = -np.log10(df['P-Value']+np.finfo(float).eps)
+        df = df.sort_values('P-Value')
+    else:
+        # if no pvalue is available, we sort by abs(log2fc)
+        # create a dummy column for pvalue
+        df['abs(log2FC)'] = np.abs(df['Log2FC'])
+        df['P-Value'] = 0.
+        df = df.sort_values('abs(log2FC)', ascending=False)
+
+    # eliminate duplicated genes, keeping the most significant result
+    # according to pvalue (or abs(log2fc))
+    df = df.drop_duplicates('Gene').dropna()
+    if df.Gene.dtype == float:
+        df['Gene'] = df['Gene'].astype(int)
+    df['Gene'] = df['Gene'].astype(str)
+
+    # keep only genes available in the network
+    df = df.loc[get_target_rows(network_hash, df['Gene']) >= 0]
+
+    return df.reset_index(drop=True)
+
+
+def get_de_values(df, logfc_threshold, p_val_threshold):
+    # -1, 0 or 1 for each row of a cleaned evidence table
+    logfc = df['Log2FC'].to_numpy()
+    de = np.where(logfc >= logfc_threshold, 1, np.where(logfc <= -logfc_threshold, -1, 0))
+    if '-log10(P-Value)' in df.columns:
+        de = de * (df['P-Value'].to_numpy() < p_val_threshold)
+
+    return de
+
+
+@lru_cache(maxsize=evidence_cache_size)
+def get_de_table(upload_key, columns, network_hash, logfc_threshold, p_val_threshold):
+    # the DE genes of a cleaned evidence table, with their direction
+    df = get_evidence_table(upload_key, columns, network_hash)
+    de = get_de_values(df, logfc_threshold, p_val_threshold)
+
+    evidence_map = np.array(['down', '', 'up'])
+    df = df.assign(**{'DE value': de, 'evidence': evidence_map[de + 1]})
+    return df.loc[de != 0]
+
+
+def decimate_points(x, y, n_bins=(400, 300)):
+    # indices of the points to draw. Below volcano_max_points every point is
+    # kept, above it the plane is split in a grid about the size of a few
+    # screen pixels and a single point is kept per occupied cell. Dense
+    # regions thin out while isolated points, the interesting ones, stay
+    if len(x) <= volcano_max_points:
+        return np.arange(len(x))
+
+    def bin_of(v, n):
+        lo, hi = np.nanmin(v), np.nanmax(v)
+        return np.clip(((v - lo) / max(hi - lo, 1e-12) * n).astype(int), 0, n - 1)
+
+    cells = bin_of(x, n_bins[0]) * n_bins[1] + bin_of(y, n_bins[1])
+    _, keep = np.unique(cells, return_index=True)
+    return np.sort(keep)
+
+
+# DataTables with page_action='custom' only receive the rows of the page they
+# show. Filtering, sorting and slicing run here, on the cached frames, with the
+# filter syntax of the DataTable
+filter_operators = [['ge ', '>='], ['le ', '<='], ['lt ', '<'], ['gt ', '>'], ['ne ', '!='], ['eq ', '='],
+                    ['contains '], ['datestartswith ']]
+
+
+def split_filter_part(filter_part):
+    # the column, the operator, the value parsed as a number when it is one,
+    # and the value as it was typed, for text columns. IDs like 7157 are text
+    for operator_type in filter_operators:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+
+                value_part = value_part.strip()
+                v0 = value_part[:1]
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = raw = value_part[1:-1].replace('\\' + v0, v0)
+                else:
+                    raw = value_part
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+
+                return name, operator_type[0].strip(), value, raw
+
+    return None, None, None, None
+
+
+def filter_table(df, filter_query):
+    for filter_part in filter_query.split(' && '):
+        name, operator, value, raw = split_filter_part(filter_part)
+        if name not in df.columns:
+            continue
+
+        col = df[name]
+        numeric = col.dtype.kind in 'biuf'
+        if operator in ['eq', 'ne', 'lt', 'le', 'gt', 'ge']:
+            try:
+                rows = getattr(col, operator)(value if numeric else raw)
+            except TypeError:
+                # a word typed in a number column
+                rows = getattr(col.astype(str), operator)(raw)
+        elif operator == 'contains':
+            rows = col.astype(str).str.contains(raw, regex=False)
         else:
-            file = self.gfs.find_one({'_id': hash})
-            if filename != file.filename:
-                raise ValueError('filename is different')
+            rows = col.astype(str).str.startswith(raw)
+        df = df.loc[rows]
+
+    return df
 
-        return hash
 
-    def load_file(self, hash):
+def table_page(df, page_current, page_size, sort_by, filter_query):
+    # the records of one page, and the number of pages
+    if filter_query:
+        df = filter_table(df, filter_query)
+    if sort_by:
+        df = df.sort_values([s['column_id'] for s in sort_by],
+                            ascending=[s['direction'] == 'asc' for s in sort_by])
 
-        file = self.gfs.find_one({'_id': hash})
-        return file.read(), file.filename
+    page_count = max(1, -(-len(df) // page_size))
+    start = min(page_current or 0, page_count - 1) * page_size
+    return df.iloc[start:start + page_size].to_dict('records'), page_count
 
 
 DEFAULT_CONFIG = { 'uniform_t': False, 't_alpha': None, 't_beta': None,
                    'zy': 0.99, 'zn': 0., 's_leniency': 0.1}
 
+def get_job_key(network_hash, evidence_hash, config):
+    # identical inputs and settings give identical results, so this key
+    # identifies the result of a job before it runs
+    key = json.dumps([network_hash, evidence_hash, config], sort_keys=True).encode()
+    return sha256(key).hexdigest()
+
+
+# seconds a new job may go without its task being sent. Past that, the
+# process that created it is assumed to have died before sending it
+job_send_grace = float(os.environ.get('NLB_JOB_SEND_GRACE', 60))
+
+
+def job_is_dead(job):
+    # decided on the job document, not the result backend, whose records
+    # expire. A job without a result is alive unless the worker recorded that
+    # it failed or was revoked, or its task was never sent
+    if job.get('state') in ['FAILURE', 'REVOKED']:
+        return True
+    if job.get('sent') is False:
+        age = datetime.now() - datetime.fromisoformat(job['submit_time'])
+        return age.total_seconds() > job_send_grace
+    return False
+
+
+def send_job(job, priority):
+    # jobs are sent to the queue they were routed to when first submitted
+    jobs = get_jobs()
+    worker.send_task('ornor_inference', kwargs={'job_id': str(job['_id'])}, task_id=job['task_id'],
+                     queue=job.get('queue', 'celery'), priority=priority)
+    jobs.update_one({'_id': job['_id'], 'task_id': job['task_id']}, {'$set': {'sent': True}})
+
+
+_jobs_indexed = False
+
 def submit_job(network, evidence, config=DEFAULT_CONFIG):
+    global _jobs_indexed
+
+    jobs = get_jobs()
+    fs = get_fs()
 
-    mongo_client = MongoClient(mongo_url)
-    jobs = mongo_client.nlbayes_job_db.jobs
-    fs = NLBayesFS(mongo_client)
+    if not _jobs_indexed:
+        # jobs submitted before job keys were introduced don't have one
+        jobs.create_index('job_key', unique=True, partialFilterExpression={'job_key': {'$exists': True}})
+        _jobs_indexed = True
 
-    network_b = json.dumps(network).encode()
-    network_hash = fs.save_file(network_b, 'network.json')
+    # network is either the hash of a registered network or a network dict
+    if isinstance(network, str):
+        network_hash, n_edges = network, len(get_network(network).mor)
+    else:
+        network_hash, n_edges = fs.save_network(network), sum(len(d) for d in network.values())
 
     evidence_b = json.dumps(evidence).encode()
     evidence_hash = fs.save_file(evidence_b, 'evidence.json')
 
+    queue, priority = route_job(estimate_job_cost(n_edges, len(evidence)))
+
+    job_key = get_job_key(network_hash, evidence_hash, config)
     data = { 'network_hash': network_hash,
              'evidence_hash': evidence_hash,
              'config' : config,
+             'job_key': job_key,
+             'task_id': str(uuid4()),
+             'sent': False,
+             'queue': queue,
+             'submit_time': datetime.now().isoformat(), }
+
+    # a single atomic upsert either creates the job, or returns the one that
+    # already exists for the same inputs, finished or still in flight
+    try:
+        job = jobs.find_one_and_update(
+            {'job_key': job_key}, {'$setOnInsert': data},
+            upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        # lost an upsert race against an identical submission
+        job = jobs.find_one({'job_key': job_key})
+
+    job_id, task_id = str(job['_id']), job['task_id']
+    if task_id == data['task_id']:
+        send_job(job, priority)
+        print('job object created:', job_id, flush=True)
+
+    elif 'posterior_hash' in job:
+        print('job result found in cache:', job_id, flush=True)
+
+    elif job_is_dead(job):
+        # don't attach to a job that will never finish, run it again instead.
+        # The failed run's meta and checkpoints go, so the new run starts over
+        job = jobs.find_one_and_update(
+            {'_id': job['_id'], 'task_id': task_id},
+            {'$set': {'task_id': data['task_id'], 'sent': False, 'submit_time': data['submit_time']},
+             '$unset': {'meta': '', 'checkpoints': '', 'state': '', 'error': '', 'end_time': '', 'attempts': ''}},
+            return_document=ReturnDocument.AFTER)
+        if job is not None and job['task_id'] == data['task_id']:
+            task_id = data['task_id']
+            send_job(job, priority)
+            print('job object resubmitted:', job_id, flush=True)
+        else:
+            job = jobs.find_one({'job_key': job_key})
+            task_id = job['task_id']
+
+    else:
+        print('attached to job in progress:', job_id, flush=True)
+
+    print(f"{task_id=}", flush=True)
+
+    return job_id, task_id, job
+
+
+def submit_batch_job(network, evidences, config=DEFAULT_CONFIG):
+    # a single job that runs every evidence set against the same network.
+    # Submitted through the batch endpoint, see batch_api.py
+    jobs = get_jobs()
+    fs = get_fs()
+
+    if isinstance(network, str):
+        network_hash, n_edges = network, len(get_network(network).mor)
+    else:
+        network_hash, n_edges = fs.save_network(network), sum(len(d) for d in network.values())
+
+    evidence_hashes = []
+    for evidence in evidences:
+        evidence_b = json.dumps(evidence).encode()
+        evidence_hashes.append(fs.save_file(evidence_b, 'evidence.json'))
+
+    n_evidence = max([len(e) for e in evidences], default=0)
+    queue, priority = route_job(estimate_job_cost(n_edges, n_evidence, len(evidences)))
+
+    data = { 'network_hash': network_hash,
+             'evidence_hashes': evidence_hashes,
+             'config' : config,
+             'queue': queue,
              'submit_time': datetime.now().isoformat(), }
 
     job_id = str(jobs.insert_one(data).inserted_id)
-    task_id = worker.send_task('ornor_inference', kwargs={'job_id': job_id}).task_id
+    task_id = worker.send_task('ornor_batch_inference', kwargs={'job_id': job_id},
+                               queue=queue, priority=priority).task_id
+    jobs.update_one({'_id': ObjectId(job_id)}, {'$set': {'task_id': task_id}})
 
-    print('job object created:', job_id, flush=True)
+    print('batch job object created:', job_id, flush=True)
     print(f"{task_id=}", flush=True)
 
-    mongo_client.close()
     return job_id, task_id, data
 
 
 def get_job_status(task_id):
-    res = worker.AsyncResult(task_id, task_name='ornor_inference')
-    return res._get_task_meta()
+    return worker.backend.get_task_meta(task_id)
+
+
+def progress_channel(task_id):
+    # the worker publishes the state of its tasks on this redis channel
+    return f'nlbayes:progress:{task_id}'
+
+
+# seconds a browser refused a progress stream waits before asking again. It
+# polls the job status meanwhile
+progress_retry_after = float(os.environ.get('NLB_PROGRESS_RETRY_AFTER', 30))
 
 
 def load_json_file(posterior_hash):
-    mongo_client = MongoClient(mongo_url)
-    fs = NLBayesFS(mongo_client)
-    content, filename = fs.load_file(posterior_hash)
+    content, filename = get_fs().load_file(posterior_hash)
     assert filename.endswith('.json')
 
     return json.loads(content)
 
+
+@lru_cache(maxsize=posterior_cache_size)
+def get_posterior_table(posterior_hash):
+    # the results table, sorted by X. Posteriors never change, so the hash is
+    # enough of a key. Shared by callers, it must not be modified
+    posterior = load_json_file(posterior_hash)
+    posterior_df = pd.DataFrame(posterior).reset_index().sort_values('X', ascending=False)
+    posterior_df.columns = ['TF', 'X', 'T']
+    return posterior_df
+
+
+def annotation_path(organism):
+    return os.path.join("assets", "data", "annotations", str(organism), "ncbi", "symbol.json")
+
+
+def annotation_version(organism):
+    # annotation files may be updated in place, their mtime and size tell.
+    # None when the organism has none
+    try:
+        st = os.stat(annotation_path(organism))
+    except OSError:
+        return None
+    return f'{st.st_mtime_ns:x}-{st.st_size:x}'
+
+
+def get_annotation(organism):
+    # gene id to symbol map, empty when the organism has none
+    return _load_annotation(organism, annotation_version(organism))
+
+
+@lru_cache(maxsize=annotation_cache_size)
+def _load_annotation(organism, version):
+    # cached by version, so an updated file is read again
+    if version is None:
+        return {}
+    with open(annotation_path(organism)) as file:
+        return json.load(file)
+
+
+def get_result_table(posterior_hash, organism):
+    posterior_df = get_posterior_table(posterior_hash)
+    annotation = get_annotation(organism)
+    if not annotation or posterior_df['TF'].isin(annotation.keys()).sum() == 0:
+        return posterior_df
+
+    symbols = posterior_df['TF'].map(annotation)
+    return posterior_df.assign(symbol=symbols).iloc[:, [0, 3, 1, 2]]
+
+
+def cache_stats():
+    # hit and miss counters of the in-process caches, for the metrics endpoint
+    caches = { 'network': get_network,
+               'network_index': get_network_index,
+               'preview': get_upload_table,
+               'evidence': get_evidence_table,
+               'de_table': get_de_table,
+               'posterior': get_posterior_table,
+               'annotation': _load_annotation, }
+    return {name: fn.cache_info() for name, fn in caches.items()}
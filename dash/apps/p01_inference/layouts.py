@@ -135,8 +135,11 @@ menu = [
 ]
 
 body = [
+    # progress is pushed to job-progress by the server, the timer only polls
+    # when the browser can't keep the event stream open
     dcc.Interval('inference-progress-timer', 5000, disabled=True),
     dcc.Store('queue-task-info'),
+    dcc.Store('job-progress'),
 
     dcc.Store('data-uploaded-network', data={}),
     dcc.Store('data-selected-network', data={}),
@@ -151,7 +154,7 @@ body = [
     dbc.Row(dbc.Col(
         dbc.Card([
             dbc.CardBody(dbc.Row([
-                dbc.Col(html.H5("Input Data (top 50 preview)", className='card-title'), class_name='mt-0'),
+                dbc.Col(html.H5("Input Data", className='card-title'), class_name='mt-0'),
                 dbc.Col(html.Div(id='output-data-upload'), width=12),
             ])),
         ],),
@@ -159,7 +162,7 @@ body = [
     dbc.Row(dbc.Col(
         dbc.Card([
             dbc.CardBody(dbc.Row([
-                dbc.Col(html.H5("Processed Data (top 50 preview)", className='card-title'), class_name='mt-0'),
+                dbc.Col(html.H5("Processed Data (DE genes)", className='card-title'), class_name='mt-0'),
                 dbc.Col(html.Div(id='processed-data-table'), width=12),
             ])),
         ],),
@@ -168,7 +171,7 @@ body = [
         dbc.Card([
             dbc.CardBody(dbc.Row([
                 dbc.Col(html.H5("Volcano Plot", className='card-title'), class_name='mt-0'),
-                dbc.Col(html.Div(id='volcano-plot'), width=12),
+                dbc.Col(html.Div(dcc.Graph(id='volcano-plot-graph'), id='volcano-plot', style={'display': 'none'}), width=12),
             ])),
         ],),
     ), class_name="mb-4 mt-4"),
@@ -180,10 +183,11 @@ body = [
                     dbc.Col(html.Div(id='inference-info'), width=12),
                 ]),
                 dbc.Row([
-                    dbc.Col([
-                        dcc.Download(id='inference-result-download'),
-                        dbc.Button('Download TSV', id='inference-result-download-button', style={'display': 'none'}),
-                    ])
+                    # links to the download endpoint, set once the result is ready
+                    dbc.Col(html.Div(dbc.ButtonGroup([
+                        dbc.Button(label, id={'type': 'inference-result-download', 'format': fmt}, external_link=True)
+                        for label, fmt in [('Download TSV', 'tsv'), ('TSV.gz', 'tsv.gz'), ('Parquet', 'parquet')]
+                    ]), id='inference-result-download-button', style={'display': 'none'}))
                 ])
             ]),
         ],),
@@ -0,0 +1,90 @@
+import os
+import re
+
+from flask import request, jsonify, abort
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+
+from app import server, url_base_pathname
+from data_access import get_jobs
+from network_catalog import networks_dir, update_catalog
+from apps.p01_inference.helper_functions import DEFAULT_CONFIG, submit_batch_job, get_job_status
+from apps.p01_inference.helper_functions import get_network, register_catalog_network
+
+
+# largest number of evidence sets accepted in one batch
+batch_max_evidence = int(os.environ.get('NLB_BATCH_MAX_EVIDENCE', 200))
+
+
+def bad_request(message):
+    response = jsonify({'error': message})
+    response.status_code = 400
+    return response
+
+
+def resolve_network(network):
+    # a network is given by its hash, if it was registered before, or by the
+    # name of a predefined network, e.g. gtex_chip/homo_sapiens/tissue_independent/three_tissue.rels
+    if re.fullmatch('[0-9a-f]{64}', network):
+        get_network(network)
+        return network
+
+    network_file = os.path.join(networks_dir, *network.split('/')) + '.json'
+    if network_file not in update_catalog():
+        raise FileNotFoundError(network)
+    return register_catalog_network(network_file)['network_hash']
+
+
+@server.route(f'{url_base_pathname}api/batch', methods=['POST'])
+def create_batch():
+    # many evidence sets against one network, run by a single worker job.
+    # Meant for pipelines that run a study's contrasts together
+    body = request.get_json(silent=True) or {}
+    network, evidences = body.get('network'), body.get('evidences')
+    if not isinstance(network, str):
+        return bad_request("'network' must be a network hash or a predefined network name")
+    if not isinstance(evidences, list) or not 0 < len(evidences) <= batch_max_evidence:
+        return bad_request(f"'evidences' must be a list of 1 to {batch_max_evidence} evidence sets")
+    for evidence in evidences:
+        if not isinstance(evidence, dict) or not all(v in [-1, 0, 1] for v in evidence.values()):
+            return bad_request("each evidence set must map gene ids to -1, 0 or 1")
+
+    config = body.get('config', {})
+    if not isinstance(config, dict) or not set(config.keys()).issubset(DEFAULT_CONFIG.keys()):
+        return bad_request(f"'config' may only set {', '.join(DEFAULT_CONFIG.keys())}")
+
+    try:
+        network_hash = resolve_network(network)
+    except FileNotFoundError:
+        return bad_request(f"unknown network: {network}")
+
+    job_id, task_id, _ = submit_batch_job(network_hash, evidences, {**DEFAULT_CONFIG, **config})
+    return jsonify({'job_id': job_id, 'task_id': task_id}), 202
+
+
+@server.route(f'{url_base_pathname}api/batch/<job_id>')
+def get_batch(job_id):
+    # progress, and once done the hash of each posterior and of the summary.
+    # Each posterior can be downloaded from the results endpoint
+    try:
+        job = get_jobs().find_one({'_id': ObjectId(job_id), 'evidence_hashes': {'$exists': True}})
+    except InvalidId:
+        abort(404)
+    if job is None:
+        abort(404)
+
+    # the job document keeps the outcome, the result backend forgets it
+    if 'summary_hash' in job:
+        status = 'SUCCESS'
+    elif 'state' in job:
+        status = job['state']
+    else:
+        status = get_job_status(job['task_id']).get('status') if 'task_id' in job else 'PENDING'
+    return jsonify({ 'job_id': job_id,
+                     'task_id': job.get('task_id'),
+                     'status': status,
+                     'error': job.get('error'),
+                     'n_evidence': len(job['evidence_hashes']),
+                     'posterior_hashes': job.get('posterior_hashes', [None] * len(job['evidence_hashes'])),
+                     'summary_hash': job.get('summary_hash'),
+                     'meta': job.get('meta', {}), })
@@ -0,0 +1,297 @@
+# Latency, peak memory and payload size of the data processing callbacks of
+# the inference page, called directly on synthetic inputs. Runs offline: the
+# broker and result backend are in memory, and GridFS is replaced by a dict.
+#
+#   cd dash && python benchmarks/bench_callbacks.py                  # quick sizes
+#   cd dash && python benchmarks/bench_callbacks.py --full           # up to 2M edges, 100k rows
+#   cd dash && python benchmarks/bench_callbacks.py --save-baseline  # store the results
+#   cd dash && python benchmarks/bench_callbacks.py --check          # compare with them
+#
+# Memory is reported twice. py_heap_peak_mb is what tracemalloc sees, Python
+# objects and numpy buffers. rss_peak_mb is the growth of the peak resident
+# memory of the process, which also covers pyarrow and other native buffers.
+# It needs Linux, to reset the peak before each case
+import gc
+import os
+import sys
+import json
+import ctypes
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+from hashlib import sha256
+
+dash_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+baseline_path = os.path.join(dash_dir, 'benchmarks', 'baselines.json')
+# how much worse than its baseline a metric may get, relative. Stored with the
+# baselines, overridden on the command line
+default_tolerance = { 'latency_s': 0.5,
+                      'py_heap_peak_mb': 0.2,
+                      'rss_peak_mb': 0.2,
+                      'payload_kb': 0.2, }
+# and by how much at least, in the metric's units. Small cases vary by more
+# than their tolerance from run to run
+default_slack = { 'latency_s': 0.005,
+                  'py_heap_peak_mb': 1.,
+                  'rss_peak_mb': 2.,
+                  'payload_kb': 1., }
+
+# set up before the app modules are imported, they read it at import time
+bench_dir = tempfile.mkdtemp(prefix='nlbayes-bench-')
+os.environ.setdefault('NLB_QUEUE_BROKER', 'memory://')
+os.environ.setdefault('NLB_QUEUE_BACKEND', 'cache+memory://')
+# never connected to, see MemoryFS
+os.environ.setdefault('NLB_DATA_STORE', 'mongodb://localhost:27017')
+os.environ['NLB_UPLOAD_CACHE_DIR'] = os.path.join(bench_dir, 'uploads')
+os.environ['NLB_CATALOG_DIR'] = os.path.join(bench_dir, 'catalog')
+os.environ['NLB_CACHE_URL'] = ''
+
+os.chdir(dash_dir)
+sys.path.insert(0, dash_dir)
+# the network codec shared with the worker
+sys.path.insert(0, os.path.join(dash_dir, '..', 'common'))
+
+from plotly.io.json import to_json_plotly
+from dash._utils import AttributeDict
+from dash._callback_context import context_value
+
+import data_access
+import upload_store
+from apps.p01_inference import helper_functions as hf
+from apps.p01_inference.callbacks import update_network_upload, update_output
+from apps.p01_inference.callbacks import process_input_data, update_job_status, update_result_page
+from benchmarks.synthetic import network_shape, make_network, make_de_table, make_posterior, encode_upload
+
+
+class MemoryFS(data_access.NLBayesFS):
+    # the content addressed store, in a dict
+
+    def __init__(self):
+        self.files = {}
+
+    def save_file(self, filebytes, filename):
+        hash = sha256(filebytes).hexdigest()
+        self.files.setdefault(hash, (filebytes, filename))
+        return hash
+
+    def load_file(self, hash):
+        if hash not in self.files:
+            raise FileNotFoundError(hash)
+        return self.files[hash]
+
+
+memory_fs = MemoryFS()
+hf.get_fs = data_access.get_fs = lambda: memory_fs
+
+
+def set_triggered(*prop_ids):
+    # the callback context the callbacks read ctx.triggered from
+    context_value.set(AttributeDict(triggered_inputs=[{'prop_id': p, 'value': None} for p in prop_ids]))
+
+
+def clear_caches():
+    for fn in [hf.get_network, hf.get_network_index, hf.get_upload_table, hf.get_evidence_table, hf.get_de_table,
+               hf.get_posterior_table, hf._load_annotation]:
+        fn.cache_clear()
+
+
+def reset_peak_rss():
+    # the peak resident memory (VmHWM) can be reset to the current one on Linux
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def release_free_memory():
+    gc.collect()
+    if upload_store.pyarrow is not None:
+        upload_store.pyarrow.default_memory_pool().release_unused()
+    try:
+        # glibc only
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def read_status_kb(field):
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+def payload_size(output):
+    # bytes of json the callback sends to the browser, serialized as dash does
+    return len(to_json_plotly(output))
+
+
+class Case:
+    # `callback` is False for helpers, their output isn't sent anywhere
+    def __init__(self, name, fn, args, triggered=(), setup=clear_caches, callback=True):
+        self.name, self.fn, self.args = name, fn, args
+        self.triggered, self.setup, self.callback = triggered, setup, callback
+
+    def call(self):
+        self.setup()
+        set_triggered(*self.triggered)
+        return self.fn(*self.args)
+
+    def run(self, repeat):
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            self.call()
+            times.append(time.perf_counter() - t0)
+
+        # memory is measured in separate runs, tracing slows everything down
+        tracemalloc.start()
+        self.call()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # memory freed by earlier runs is handed back first, or the case
+        # would reuse it without raising the peak
+        release_free_memory()
+        measured = reset_peak_rss()
+        rss_before = read_status_kb('VmRSS') if measured else None
+        output = self.call()
+        rss_peak = (read_status_kb('VmHWM') - rss_before) / 2**10 if measured else None
+
+        return { 'latency_s': statistics.median(times),
+                 'py_heap_peak_mb': peak / 2**20,
+                 'rss_peak_mb': rss_peak,
+                 'payload_kb': payload_size(output) / 2**10 if self.callback else None, }
+
+
+def build_cases(network_sizes, table_sizes):
+    cases = []
+
+    networks = {}
+    for n_edges in network_sizes:
+        contents = encode_upload(make_network(n_edges))
+        cases.append(Case(f'parse_contents/network/{n_edges}', hf.parse_contents, (contents, 'network.tsv'),
+                          callback=False))
+        cases.append(Case(f'update_network_upload/{n_edges}', update_network_upload, (contents, 'network.tsv', 0)))
+        networks[n_edges], _ = update_network_upload(contents, 'network.tsv', 0)
+
+        n_src, _ = network_shape(n_edges)
+        posterior_hash = memory_fs.save_file(json.dumps(make_posterior(n_src)).encode(), 'posterior.json')
+        info = {'job_id': 'bench', 'task_id': 'bench', 'posterior_hash': posterior_hash}
+        cases.append(Case(f'update_job_status/{n_src}tfs', update_job_status,
+                          (info, None, None, None, [{'format': 'tsv'}]), ['queue-task-info.data']))
+        result = {'posterior_hash': posterior_hash, 'organism': None}
+        cases.append(Case(f'update_result_page/{n_src}tfs', update_result_page,
+                          (3, 25, [{'column_id': 'T', 'direction': 'desc'}], '{X} ge 0.1', result)))
+
+    # the evidence is processed against the largest network of the run
+    network = networks[max(network_sizes)]
+    role_ids = [{'type': 'data-column-role', 'key': k} for k in ['gene', 'pval', 'logfc']]
+    role_columns = ['gene_id', 'padj', 'log2FoldChange']
+    for n_rows in table_sizes:
+        contents = encode_upload(make_de_table(n_rows))
+        upload_key = sha256(contents.encode()).hexdigest()
+
+        def clear_upload(upload_key=upload_key):
+            clear_caches()
+            shutil.rmtree(os.path.join(upload_store.upload_dir, upload_key), ignore_errors=True)
+
+        cases.append(Case(f'parse_contents/de_table/{n_rows}', hf.parse_contents, (contents, 'de.tsv'),
+                          callback=False))
+        cases.append(Case(f'update_output/{n_rows}', update_output, (contents, 'de.tsv', 0), setup=clear_upload))
+        _, _, _, upload = update_output(contents, 'de.tsv', 0)
+
+        args = (upload, role_ids, role_columns, network, '1', '1e-3')
+        cases.append(Case(f'process_input_data/{n_rows}', process_input_data, args, ['input-data.data']))
+
+        # a threshold change, with the cleaned table already cached
+        set_triggered('input-data.data')
+        process_input_data(*args)
+        args = (upload, role_ids, role_columns, network, '0.5', '1e-2')
+        cases.append(Case(f'process_input_data/thresholds/{n_rows}', process_input_data, args,
+                          ['logfc-threshold.value'], setup=hf.get_de_table.cache_clear))
+
+    return cases
+
+
+def check_regressions(results, baselines, tolerance, slack):
+    # metrics worse than the baseline by more than the tolerance, as messages.
+    # Metrics without a baseline, or not measured on this platform, are skipped
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        for metric, value in result.items():
+            if value is None or baseline.get(metric) is None:
+                continue
+            limit = baseline[metric] * (1 + tolerance[metric])
+            if value > limit and value - baseline[metric] > slack[metric]:
+                regressions.append(f'{name} {metric}: {value:.4g} > {baseline[metric]:.4g} (+{tolerance[metric]:.0%})')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--full', action='store_true', help='include the largest inputs, 2M edges and 100k rows')
+    parser.add_argument('--repeat', type=int, default=9)
+    parser.add_argument('--filter', type=str, default='', help='only run cases whose name contains this')
+    parser.add_argument('--output', type=str, help='write the results to this json file')
+    parser.add_argument('--save-baseline', action='store_true', help=f'store the results in {baseline_path}')
+    parser.add_argument('--check', action='store_true', help='exit with an error on regressions')
+    parser.add_argument('--latency-tolerance', type=float, help='overrides the one stored with the baselines')
+    parser.add_argument('--memory-tolerance', type=float, help='overrides the one stored with the baselines')
+    args = parser.parse_args()
+
+    network_sizes = [1000, 100000, 2000000] if args.full else [1000, 100000]
+    table_sizes = [1000, 10000, 100000] if args.full else [1000, 10000]
+
+    try:
+        cases = [c for c in build_cases(network_sizes, table_sizes) if args.filter in c.name]
+
+        results = {}
+        print(f"{'case':48s} {'latency ms':>12s} {'py heap MB':>12s} {'rss MB':>10s} {'payload KB':>12s}")
+        for case in cases:
+            results[case.name] = r = case.run(args.repeat)
+            rss, payload = ('n/a' if r[k] is None else f"{r[k]:.2f}" for k in ['rss_peak_mb', 'payload_kb'])
+            print(f"{case.name:48s} {r['latency_s'] * 1e3:12.2f} {r['py_heap_peak_mb']:12.2f} {rss:>10s} "
+                  f"{payload:>12s}", flush=True)
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
+
+    stored = {'tolerance': default_tolerance, 'slack': default_slack, 'cases': {}}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as file:
+            stored = json.load(file)
+
+    tolerance = dict(stored['tolerance'])
+    if args.latency_tolerance is not None:
+        tolerance['latency_s'] = args.latency_tolerance
+    if args.memory_tolerance is not None:
+        tolerance.update({k: args.memory_tolerance for k in ['py_heap_peak_mb', 'rss_peak_mb', 'payload_kb']})
+
+    if args.save_baseline:
+        stored['tolerance'] = tolerance
+        stored['cases'].update(results)
+        with open(baseline_path, 'w') as file:
+            json.dump(stored, file, indent=1, sort_keys=True)
+        print(f'baseline saved: {baseline_path}')
+
+    if args.check:
+        if not stored['cases']:
+            sys.exit('no baseline to compare with, run with --save-baseline first')
+        regressions = check_regressions(results, stored['cases'], tolerance, stored['slack'])
+        for message in regressions:
+            print(f'regression: {message}')
+        if regressions:
+            sys.exit(1)
+        print('no regressions')
@@ -0,0 +1,65 @@
+# Compares the conversion of an uploaded edge list into a network, as done by
+# update_network_upload before and after the vectorized converter.
+#
+#   cd dash && python benchmarks/bench_network_upload.py --edges 1000000
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# the network codec shared with the worker
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'common'))
+from network_codec import compact_from_dict, compact_from_edges
+from benchmarks.synthetic import make_network
+
+
+def legacy_convert(network):
+    dff = network.set_index(['tf', 'gene'])
+    dff = dff.groupby(level=0).apply(lambda df: df.xs(df.name)['mor'].to_dict())
+    network = dff.to_dict()
+
+    n_src = len(network.keys())
+    n_trg = len(set([k for d in network.values() for k in d.keys()]))
+    n_rel = sum([len(d) for d in network.values()])
+    return compact_from_dict(network), (n_src, n_trg, n_rel)
+
+
+def vectorized_convert(network):
+    net = compact_from_edges(network['tf'].to_numpy(), network['gene'].to_numpy(), network['mor'].to_numpy())
+    return net, (len(net.src_ids), len(net.trg_ids), len(net.mor))
+
+
+def timeit(fn, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--edges', type=int, default=200000)
+    parser.add_argument('--tfs', type=int, default=1500)
+    parser.add_argument('--genes', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_network(args.edges, args.tfs, args.genes)
+    t_legacy, (net_legacy, stats_legacy) = timeit(legacy_convert, df, repeat=args.repeat)
+    t_vector, (net_vector, stats_vector) = timeit(vectorized_convert, df, repeat=args.repeat)
+
+    # both must give exactly the same network
+    assert stats_legacy == stats_vector
+    assert net_legacy.src_ids == net_vector.src_ids and net_legacy.trg_ids == net_vector.trg_ids
+    for a, b in zip(net_legacy[2:], net_vector[2:]):
+        assert np.array_equal(a, b)
+
+    print(f"{args.edges} edges, {stats_vector[0]} tfs, {stats_vector[1]} genes, {stats_vector[2]} unique edges")
+    print(f"legacy groupby:  {t_legacy:8.3f} s")
+    print(f"vectorized:      {t_vector:8.3f} s")
+    print(f"speedup:         {t_legacy / t_vector:8.1f}x")
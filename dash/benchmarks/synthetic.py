@@ -0,0 +1,57 @@
+# Synthetic inputs for the benchmarks: edge lists, differential expression
+# tables and posteriors that look like the real ones in shape and size. Gene
+# and TF ids are integers, as strings, so the DE tables overlap the networks
+import io
+import base64
+
+import numpy as np
+import pandas as pd
+
+
+def network_shape(n_edges):
+    # number of TFs and target genes of a network with n_edges, capped at
+    # about what the largest predefined networks have
+    n_src = min(1500, max(10, n_edges // 100))
+    n_trg = min(20000, max(100, n_edges // 5))
+    return n_src, n_trg
+
+
+def make_network(n_edges, n_src=None, n_trg=None, seed=0):
+    default_src, default_trg = network_shape(n_edges)
+    n_src, n_trg = n_src or default_src, n_trg or default_trg
+
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'tf': rng.integers(0, n_src, n_edges).astype(str),
+        'gene': rng.integers(0, n_trg, n_edges).astype(str),
+        'mor': rng.choice([-1, 0, 1], n_edges),
+    })
+
+
+def make_de_table(n_rows, n_genes=20000, seed=0):
+    # a DESeq2-like results table. When there are more rows than network
+    # genes, the rest are genes the network doesn't have
+    rng = np.random.default_rng(seed)
+    genes = rng.permutation(max(n_rows, n_genes))[:n_rows]
+    return pd.DataFrame({
+        'gene_id': genes,
+        'baseMean': rng.gamma(2., 200., n_rows),
+        'log2FoldChange': rng.normal(0., 1.5, n_rows),
+        'pvalue': rng.uniform(0., 1., n_rows) ** 3,
+        'padj': np.minimum(1., rng.uniform(0., 1., n_rows) ** 2),
+    })
+
+
+def make_posterior(n_src, seed=0):
+    rng = np.random.default_rng(seed)
+    tfs = [str(i) for i in range(n_src)]
+    return { 'X': dict(zip(tfs, rng.beta(0.5, 2., n_src).tolist())),
+             'T': dict(zip(tfs, rng.beta(2., 2., n_src).tolist())), }
+
+
+def encode_upload(df, sep='\t'):
+    # what dcc.Upload hands to the callbacks
+    buffer = io.StringIO()
+    df.to_csv(buffer, sep=sep, index=False)
+    content = base64.b64encode(buffer.getvalue().encode()).decode()
+    return f'data:text/tab-separated-values;base64,{content}'
@@ -0,0 +1,129 @@
+import os
+import time
+import threading
+from hashlib import sha256
+
+import gridfs
+from gridfs.errors import FileExists
+from pymongo import MongoClient, monitoring
+
+from network_codec import encode_network
+from shared_cache import cache_get, cache_set
+
+
+mongo_url = os.environ['NLB_DATA_STORE']
+# connections each dash process may open, shared by all its callback threads
+mongo_pool_size = int(os.environ.get('NLB_MONGO_POOL_SIZE', 20))
+
+
+class CommandStats(monitoring.CommandListener):
+    # count, total and max latency of every command sent to mongo, by command
+    # and database. GridFS operations show up as the commands they are made of
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, event, failed):
+        key = (event.database_name, event.command_name)
+        seconds = event.duration_micros / 1e6
+        with self.lock:
+            count, total, longest, errors = self.stats.get(key, (0, 0., 0., 0))
+            self.stats[key] = (count + 1, total + seconds, max(longest, seconds), errors + failed)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event, False)
+
+    def failed(self, event):
+        self.record(event, True)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+command_stats = CommandStats()
+
+
+class NLBayesFS:
+    def __init__(self, mongo_client) -> None:
+        gfs_db = mongo_client.nlbayes_gfs_db
+        self.gfs = gridfs.GridFS(gfs_db)
+
+    def save_file(self, filebytes, filename):
+        # files are stored under their content hash, so a blob that is already
+        # there is found by the insert itself, without asking first
+        hash = sha256(filebytes).hexdigest()
+
+        try:
+            self.gfs.put(filebytes, _id=hash, filename=filename)
+        except FileExists:
+            # a concurrent put of the same blob may not have written its file
+            # document yet. The content is the same either way
+            for _ in range(10):
+                file = self.gfs.find_one({'_id': hash})
+                if file is not None:
+                    break
+                time.sleep(0.1)
+            if file is not None and filename != file.filename:
+                raise ValueError('filename is different')
+
+        return hash
+
+    def load_file(self, hash):
+        # blobs never change, so a copy in the shared cache is always valid
+        cached = cache_get(f'blob:{hash}')
+        if cached is not None:
+            filename, content = cached.split(b'\n', 1)
+            return content, filename.decode()
+
+        file = self.gfs.find_one({'_id': hash})
+        if file is None:
+            raise FileNotFoundError(hash)
+        content = file.read()
+        cache_set(f'blob:{hash}', file.filename.encode() + b'\n' + content)
+        return content, file.filename
+
+    def save_network(self, network):
+        # networks are stored in a compact, canonical binary form. The same
+        # network always gets the same hash, regardless of key order
+        return self.save_file(encode_network(network), 'network.nlbnet')
+
+
+# MongoClient is thread safe and keeps its own connection pool, but it is not
+# fork safe. Each process, e.g. each gunicorn worker, creates one on first use
+# and every callback thread of that process shares it
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_fs = None
+
+
+def get_mongo_client():
+    global _client, _client_pid, _fs
+
+    if _client is None or _client_pid != os.getpid():
+        with _lock:
+            if _client is None or _client_pid != os.getpid():
+                _fs = None
+                _client = MongoClient(mongo_url, maxPoolSize=mongo_pool_size, event_listeners=[command_stats])
+                _client_pid = os.getpid()
+
+    return _client
+
+
+def get_fs():
+    global _fs
+
+    client = get_mongo_client()
+    if _fs is None:
+        _fs = NLBayesFS(client)
+
+    return _fs
+
+
+def get_jobs():
+    return get_mongo_client().nlbayes_job_db.jobs
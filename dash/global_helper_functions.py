@@ -1,13 +1,20 @@
 import os
-from glob import glob
+from fnmatch import fnmatch
 import bibtexparser
 
 from dash import html
 
+from network_catalog import update_catalog
+
 
 def get_networks(net_source = '*', net_organism = '*', net_type = '*'):
+    # network files come from the catalog, which is only rebuilt for the files
+    # that changed since it was last written
+    pattern = os.path.join('assets', 'data', 'networks', net_source, net_organism, net_type, '*.json')
     networks = {}
-    for network_file in glob(os.path.join('assets', 'data', 'networks', net_source, net_organism, net_type, '*.json')):
+    for network_file in sorted(update_catalog().keys()):
+        if not fnmatch(network_file, pattern):
+            continue
         _, _, _, s, o, t, n = os.path.splitext(network_file)[0].split(os.sep)
 
         if not s in networks.keys():
@@ -0,0 +1,33 @@
+# production server settings, used as
+#   gunicorn -c gunicorn.conf.py index:server
+# every setting can be overridden with an environment variable
+import os
+import multiprocessing
+
+
+bind = os.environ.get('NLB_WEB_BIND', ':8050')
+
+# the app, the page modules and the network catalog are loaded once, in the
+# master, and shared copy-on-write by the workers. Connections to mongo and
+# redis are opened lazily, after the fork, by each worker
+preload_app = True
+
+# callbacks mostly wait on mongo, redis and the disk, so each worker process
+# serves many requests with threads. Progress streams hold a thread while
+# they are open, at most NLB_PROGRESS_MAX_STREAMS of them per worker, and
+# must stay well below the thread count
+worker_class = 'gthread'
+workers = int(os.environ.get('NLB_WEB_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('NLB_WEB_THREADS', 32))
+
+# uploads of large tables take a while to parse
+timeout = int(os.environ.get('NLB_WEB_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# workers are recycled from time to time, their caches start over
+max_requests = int(os.environ.get('NLB_WEB_MAX_REQUESTS', 2000))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+errorlog = '-'
@@ -7,6 +7,12 @@ from dash.dependencies import Input, Output, State, MATCH
 
 from app import app, server, url_base_pathname
 import apps
+# registers the metrics, job progress, result download and batch job
+# endpoints on the flask server
+import metrics
+import progress_stream
+import result_download
+import batch_api
 
 import dash_bootstrap_components as dbc
 
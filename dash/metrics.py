@@ -0,0 +1,123 @@
+import os
+import time
+
+from flask import Response
+
+from app import server, url_base_pathname
+from apps.p01_inference.helper_functions import cache_stats
+from data_access import get_jobs, command_stats
+from shared_cache import shared_cache_stats
+
+
+# number of most recent finished jobs aggregated by the metrics endpoint
+metrics_window = int(os.environ.get('NLB_METRICS_WINDOW', 500))
+# seconds a rendered metrics page is reused, so scrapers don't load the db
+metrics_ttl = float(os.environ.get('NLB_METRICS_TTL', 15))
+
+quantiles = [0.5, 0.9, 0.99]
+
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summary_lines(name, help, samples):
+    # prometheus summary, one series per label set
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} summary']
+    for labels, values in samples.items():
+        if not values:
+            continue
+        sep = ',' if labels else ''
+        for q in quantiles:
+            lines.append(f'{name}{{{labels}{sep}quantile="{q}"}} {quantile(values, q):.6g}')
+        lines.append(f'{name}_sum{{{labels}}} {sum(values):.6g}')
+        lines.append(f'{name}_count{{{labels}}} {len(values)}')
+    return lines
+
+
+def collect_job_metrics():
+    jobs = get_jobs()
+    cursor = jobs.find({'meta.timings': {'$exists': True}}, {'meta': 1, 'queue': 1})
+    recent = list(cursor.sort('_id', -1).limit(metrics_window))
+
+    phases, rates, rss, chains_rss = {}, {}, {}, {}
+    for job in recent:
+        meta = job['meta']
+        queue = job.get('queue', 'celery')
+        for phase, seconds in meta['timings'].items():
+            phases.setdefault(f'queue="{queue}",phase="{phase}"', []).append(seconds)
+        if 'sampling_rate' in meta:
+            rates.setdefault(f'queue="{queue}"', []).append(meta['sampling_rate'])
+        if 'peak_rss_kb' in meta:
+            rss.setdefault(f'queue="{queue}"', []).append(meta['peak_rss_kb'] * 1024)
+        if 'chains_peak_rss_kb' in meta:
+            chains_rss.setdefault(f'queue="{queue}"', []).append(meta['chains_peak_rss_kb'] * 1024)
+
+    lines = []
+    lines += summary_lines('nlbayes_job_phase_seconds',
+                           f'Wall time of each inference job phase, last {metrics_window} jobs', phases)
+    lines += summary_lines('nlbayes_job_sampling_rate',
+                           'Samples per second in the sampling phase', rates)
+    lines += summary_lines('nlbayes_job_peak_rss_bytes',
+                           'Peak resident memory of the worker during the job', rss)
+    lines += summary_lines('nlbayes_job_chains_peak_rss_bytes',
+                           'Peak resident memory of the largest parallel chain of the job', chains_rss)
+    return lines
+
+
+def collect_cache_metrics():
+    # per process counters, each gunicorn worker reports its own
+    stats = cache_stats()
+    lines = []
+    for name, help, field in [
+            ('nlbayes_cache_hits_total', 'Lookups served from an in-process cache', 'hits'),
+            ('nlbayes_cache_misses_total', 'Lookups that had to compute or load the value', 'misses'),
+            ('nlbayes_cache_entries', 'Entries held by an in-process cache', 'currsize'), ]:
+        kind = 'gauge' if field == 'currsize' else 'counter'
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+        for cache, info in stats.items():
+            lines.append(f'{name}{{cache="{cache}",pid="{os.getpid()}"}} {getattr(info, field)}')
+
+    # the shared cache, as seen by this process
+    shared = shared_cache_stats()
+    for name, field in [('nlbayes_cache_hits_total', 'hits'), ('nlbayes_cache_misses_total', 'misses')]:
+        lines.append(f'{name}{{cache="shared",pid="{os.getpid()}"}} {shared[field]}')
+    return lines
+
+
+def collect_data_access_metrics():
+    # latency of the commands this process sent to mongo, kept as count, sum
+    # and max, so it costs nothing on the request path
+    stats = command_stats.snapshot()
+    labels = {k: f'db="{k[0]}",command="{k[1]}",pid="{os.getpid()}"' for k in stats.keys()}
+
+    name = 'nlbayes_mongo_command_seconds'
+    lines = [f'# HELP {name} Latency of the mongo commands sent by the dash process', f'# TYPE {name} summary']
+    for k, (count, total, longest, errors) in stats.items():
+        lines.append(f'{name}_sum{{{labels[k]}}} {total:.6g}')
+        lines.append(f'{name}_count{{{labels[k]}}} {count}')
+
+    for name, kind, help, i in [
+            ('nlbayes_mongo_command_max_seconds', 'gauge', 'Slowest mongo command of each kind', 2),
+            ('nlbayes_mongo_command_errors_total', 'counter', 'Mongo commands that failed', 3), ]:
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+        for k, stat in stats.items():
+            lines.append(f'{name}{{{labels[k]}}} {stat[i]:.6g}')
+    return lines
+
+
+_rendered = None
+_rendered_time = float('-inf')
+
+@server.route(f'{url_base_pathname}metrics')
+def metrics():
+    global _rendered, _rendered_time
+
+    if time.monotonic() - _rendered_time > metrics_ttl:
+        _rendered = '\n'.join(collect_job_metrics()) + '\n'
+        _rendered_time = time.monotonic()
+
+    # cheap to collect, always fresh
+    rendered = _rendered + '\n'.join(collect_cache_metrics() + collect_data_access_metrics()) + '\n'
+    return Response(rendered, mimetype='text/plain; version=0.0.4')
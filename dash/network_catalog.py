@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import threading
+from glob import glob
+from hashlib import sha256
+
+from network_codec import compact_from_dict, encode_network
+
+
+networks_dir = os.path.join('assets', 'data', 'networks')
+# the catalog and the compact copies of the networks it indexes
+catalog_dir = os.environ.get('NLB_CATALOG_DIR', os.path.join(networks_dir, '.catalog'))
+catalog_path = os.path.join(catalog_dir, 'catalog.json')
+# seconds between scans of the networks directory for new or modified files
+catalog_rescan = float(os.environ.get('NLB_CATALOG_RESCAN', 30))
+
+_catalog = None
+_scan_time = float('-inf')
+# the mtime and size of files that could not be indexed, by path
+_failed = {}
+# one thread rescans, the others keep using the current catalog meanwhile
+_scan_lock = threading.Lock()
+
+
+def _read_catalog():
+    try:
+        with open(catalog_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_catalog(catalog):
+    try:
+        os.makedirs(catalog_dir, exist_ok=True)
+        tmp_path = f'{catalog_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(catalog, file, indent=1)
+        os.replace(tmp_path, catalog_path)
+    except OSError as e:
+        # a read-only data volume only costs a rebuild on the next start
+        print(f"failed to write network catalog: {e}", flush=True)
+
+
+def _index_network(network_file):
+    # the only place where a raw network file is parsed. Its compact encoding
+    # is kept next to the catalog, it also serves as the network's target index
+    with open(network_file) as file:
+        net = compact_from_dict(json.load(file))
+    filebytes = encode_network(net)
+    network_hash = sha256(filebytes).hexdigest()
+
+    try:
+        os.makedirs(catalog_dir, exist_ok=True)
+        cached_path = os.path.join(catalog_dir, f'{network_hash}.nlbnet')
+        if not os.path.exists(cached_path):
+            tmp_path = f'{cached_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as file:
+                file.write(filebytes)
+            os.replace(tmp_path, cached_path)
+    except OSError as e:
+        print(f"failed to cache network {network_file}: {e}", flush=True)
+
+    return { 'hash': network_hash,
+             'n_src': len(net.src_ids),
+             'n_trg': len(net.trg_ids),
+             'n_edges': len(net.mor), }
+
+
+def update_catalog(force=False):
+    # files are only parsed again when their mtime or size changed
+    global _catalog, _scan_time
+
+    if _catalog is not None and not force and time.monotonic() - _scan_time < catalog_rescan:
+        return _catalog
+    # the first scan, or a forced one, waits for a scan in progress. Otherwise
+    # the current catalog is used until the scanning thread is done
+    if not _scan_lock.acquire(blocking=force or _catalog is None):
+        return _catalog
+
+    try:
+        return _scan_networks()
+    finally:
+        _scan_lock.release()
+
+
+def _scan_networks():
+    global _catalog, _scan_time
+
+    if _catalog is None:
+        _catalog = _read_catalog()
+
+    catalog = dict(_catalog)
+    changed = False
+    network_files = glob(os.path.join(networks_dir, '*', '*', '*', '*.json'))
+    for network_file in network_files:
+        st = os.stat(network_file)
+        entry = catalog.get(network_file)
+        if entry is None or entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+            if _failed.get(network_file) == (st.st_mtime, st.st_size):
+                continue
+            print(f"indexing network: {network_file}", flush=True)
+            try:
+                entry = _index_network(network_file)
+            except Exception as e:
+                # a bad file is left out of the catalog, and doesn't keep the
+                # app from starting. It is tried again once it is modified
+                print(f"failed to index network {network_file}: {e!r}", flush=True)
+                _failed[network_file] = (st.st_mtime, st.st_size)
+                if catalog.pop(network_file, None) is not None:
+                    changed = True
+                continue
+            entry.update({'mtime': st.st_mtime, 'size': st.st_size})
+            catalog[network_file] = entry
+            changed = True
+
+    for network_file in set(catalog.keys()).difference(network_files):
+        del catalog[network_file]
+        changed = True
+
+    if changed:
+        _write_catalog(catalog)
+        _remove_unreferenced(catalog)
+
+    _catalog = catalog
+    _scan_time = time.monotonic()
+    return _catalog
+
+
+def _remove_unreferenced(catalog):
+    # compact copies of networks that were modified or removed. Every process
+    # scans the same files, so a copy one of them still needs is referenced
+    # by its own catalog too. A network without a copy is loaded from GridFS
+    referenced = set(entry['hash'] for entry in catalog.values())
+    for cached_path in glob(os.path.join(catalog_dir, '*.nlbnet')):
+        network_hash = os.path.basename(cached_path)[:-len('.nlbnet')]
+        if network_hash not in referenced:
+            try:
+                os.remove(cached_path)
+            except OSError:
+                pass
+
+
+def get_catalog_entry(network_file):
+    return update_catalog()[network_file]
+
+
+def load_cached_network(network_hash):
+    # encoded network bytes, or None if the catalog doesn't have them
+    try:
+        with open(os.path.join(catalog_dir, f'{network_hash}.nlbnet'), 'rb') as file:
+            return file.read()
+    except OSError:
+        return None
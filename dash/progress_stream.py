@@ -0,0 +1,72 @@
+import os
+import json
+import time
+import threading
+
+from celery import states
+from flask import Response, abort
+
+from app import server, url_base_pathname
+from apps.p01_inference.helper_functions import worker, get_job_status, progress_channel, progress_retry_after
+
+
+# seconds between keep-alive comments, also how often a stream notices it ran out of time
+heartbeat_interval = float(os.environ.get('NLB_PROGRESS_HEARTBEAT', 15))
+# a stream is closed after this many seconds and the browser opens a new one,
+# so a connection (and its server thread) is never held for a whole long job
+stream_timeout = float(os.environ.get('NLB_PROGRESS_STREAM_TIMEOUT', 60))
+# streams open at once in each dash process. Every stream holds one of the
+# process's threads, the rest must be left for callbacks. Browsers refused a
+# stream poll the job status, and ask for a stream again a little later
+max_streams = int(os.environ.get('NLB_PROGRESS_MAX_STREAMS', 8))
+_stream_slots = threading.BoundedSemaphore(max_streams)
+
+
+def sse_event(meta):
+    return f"data: {json.dumps(meta, default=str)}\n\n"
+
+
+@server.route(f'{url_base_pathname}progress/<task_id>')
+def progress(task_id):
+    # server-sent events with the state of a job, relayed from the channel the
+    # worker publishes to. Without a redis result backend there is nothing to
+    # relay, and the browser falls back to polling
+    client = getattr(worker.backend, 'client', None)
+    # other backends, e.g. memcached, have a client too, without pub/sub
+    if not hasattr(client, 'pubsub'):
+        abort(404)
+
+    if not _stream_slots.acquire(blocking=False):
+        # an EventSource gives up on any response other than 200. The page
+        # then polls, and opens a new one after progress_retry_after
+        retry_ms = int(progress_retry_after * 1000)
+        return Response(f"retry: {retry_ms}\n\n", status=503, mimetype='text/event-stream',
+                        headers={'Retry-After': str(int(progress_retry_after))})
+
+    def stream():
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        # subscribed before the current state is read, so no update is missed
+        pubsub.subscribe(progress_channel(task_id))
+        try:
+            meta = get_job_status(task_id)
+            yield sse_event({'status': meta.get('status'), 'result': meta.get('result')})
+
+            status = meta.get('status')
+            start_time = time.monotonic()
+            while status not in states.READY_STATES and time.monotonic() - start_time < stream_timeout:
+                message = pubsub.get_message(timeout=heartbeat_interval)
+                if message is None:
+                    yield ': keep-alive\n\n'
+                    continue
+                meta = json.loads(message['data'])
+                status = meta.get('status')
+                yield sse_event(meta)
+        finally:
+            pubsub.close()
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    response = Response(stream(), mimetype='text/event-stream', headers=headers)
+    # released when the server is done with the response, even if the stream
+    # was never started because the client went away first
+    response.call_on_close(_stream_slots.release)
+    return response
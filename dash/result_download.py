@@ -0,0 +1,89 @@
+import io
+import re
+import zlib
+
+from flask import Response, abort, request
+
+from app import server, url_base_pathname
+from apps.p01_inference.helper_functions import get_result_table, annotation_version
+
+# optional: parquet downloads
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# rows rendered at a time when streaming text formats
+rows_per_chunk = 10000
+
+formats = { 'tsv': ('text/tab-separated-values', 'tsv'),
+            'tsv.gz': ('application/gzip', 'tsv.gz'),
+            'parquet': ('application/vnd.apache.parquet', 'parquet'), }
+
+
+def tsv_chunks(df):
+    for start in range(0, max(len(df), 1), rows_per_chunk):
+        yield df.iloc[start:start + rows_per_chunk].to_csv(sep='\t', index=False, header=start == 0).encode()
+
+
+def gzip_chunks(chunks):
+    # wbits 31 writes the gzip container, so the stream is a valid .gz file
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def parquet_bytes(df):
+    buffer = io.BytesIO()
+    pyarrow.parquet.write_table(pyarrow.Table.from_pandas(df, preserve_index=False), buffer)
+    return buffer.getvalue()
+
+
+@server.route(f'{url_base_pathname}results/<posterior_hash>')
+def download_result(posterior_hash):
+    # the results table of a job, streamed in the requested format. Posteriors
+    # are content addressed, so without annotations the response for a url
+    # never changes and browsers and proxies may keep it for good. Annotated
+    # tables are revalidated, their ETag follows the annotation file
+    fmt = request.args.get('format', 'tsv')
+    organism = request.args.get('organism', '')
+    if not re.fullmatch('[0-9a-f]{64}', posterior_hash) or not re.fullmatch('[a-z0-9_]*', organism):
+        abort(404)
+    if fmt not in formats or (fmt == 'parquet' and pyarrow is None):
+        abort(404)
+
+    mimetype, extension = formats[fmt]
+    if organism:
+        etag = f'{posterior_hash}-{organism}-{annotation_version(organism)}-{fmt}'
+        cache_control = 'no-cache'
+    else:
+        etag = f'{posterior_hash}-{fmt}'
+        cache_control = 'public, max-age=31536000, immutable'
+    headers = { 'Cache-Control': cache_control,
+                'Content-Disposition': f'attachment; filename="inference_result.{extension}"', }
+
+    if etag in request.if_none_match:
+        response = Response(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    try:
+        df = get_result_table(posterior_hash, organism or None)
+    except FileNotFoundError:
+        abort(404)
+
+    if fmt == 'parquet':
+        body = parquet_bytes(df)
+    elif fmt == 'tsv.gz':
+        body = gzip_chunks(tsv_chunks(df))
+    else:
+        body = tsv_chunks(df)
+
+    response = Response(body, mimetype=mimetype, headers=headers)
+    response.set_etag(etag)
+    return response
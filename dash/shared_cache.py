@@ -0,0 +1,69 @@
+import os
+import threading
+
+# optional: without redis every process only has its own in-memory caches
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# redis url of the cache shared by every dash process, e.g. redis://redis/1.
+# Empty disables it
+cache_url = os.environ.get('NLB_CACHE_URL', '')
+# seconds an entry is kept after it was last stored
+cache_ttl = int(os.environ.get('NLB_CACHE_TTL', 3600))
+# larger values are not worth the memory, they are read from the data store
+cache_max_bytes = int(os.environ.get('NLB_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+
+_client = None
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'errors': 0}
+
+
+def _get_client():
+    # redis-py pools reconnect by themselves after a fork
+    global _client
+
+    if _client is None and cache_url and redis is not None:
+        _client = redis.Redis.from_url(cache_url, socket_timeout=1.)
+    return _client
+
+
+def _count(key):
+    with _lock:
+        _stats[key] += 1
+
+
+def cache_get(key):
+    # the stored bytes, or None. The cache is best effort, errors are misses
+    client = _get_client()
+    if client is None:
+        return None
+
+    try:
+        value = client.get(f'nlbayes:cache:{key}')
+    except redis.RedisError as e:
+        print(f"shared cache unavailable: {e}", flush=True)
+        _count('errors')
+        return None
+
+    _count('misses' if value is None else 'hits')
+    return value
+
+
+def cache_set(key, value):
+    client = _get_client()
+    if client is None or len(value) > cache_max_bytes:
+        return
+
+    try:
+        client.set(f'nlbayes:cache:{key}', value, ex=cache_ttl)
+    except redis.RedisError as e:
+        print(f"shared cache unavailable: {e}", flush=True)
+        _count('errors')
+
+
+def shared_cache_stats():
+    with _lock:
+        return dict(_stats)
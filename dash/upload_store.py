@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# optional: uploads are stored as an Arrow file, with variable width text.
+# Without pyarrow, each column is stored as a .npy file
+try:
+    import pyarrow
+    import pyarrow.feather
+except ImportError:
+    pyarrow = None
+
+
+# uploaded tables are kept on the server, in a columnar file, so the browser
+# only holds their key and callbacks memory-map just the columns they read.
+# The directory is shared by every dash process on the host
+upload_dir = os.environ.get('NLB_UPLOAD_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'nlbayes_uploads'))
+# seconds an upload is kept after it was last uploaded
+upload_ttl = float(os.environ.get('NLB_UPLOAD_CACHE_TTL', 24 * 3600))
+
+
+def _arrow_table(df):
+    # numeric columns are stored as they are, anything else as text. Columns of
+    # mixed types would not convert otherwise
+    data = {}
+    for col in df.columns:
+        series = df[col]
+        if series.dtype.kind not in 'biuf':
+            series = series.astype(str).where(series.notna(), None)
+        data[str(col)] = pyarrow.array(series, from_pandas=True)
+    return pyarrow.table(data)
+
+
+def _column_arrays(series):
+    # without pyarrow. Numeric columns are stored as they are. Anything else is
+    # stored as fixed width unicode, plus a mask of the missing values, so no
+    # pickling is needed
+    if series.dtype.kind in 'biuf':
+        return series.to_numpy(), None
+
+    mask = series.isna().to_numpy()
+    values = series.astype(str).to_numpy().astype(str)
+    return values, (mask if mask.any() else None)
+
+
+def _prune_uploads():
+    now = time.time()
+    for name in os.listdir(upload_dir):
+        path = os.path.join(upload_dir, name)
+        try:
+            if now - os.path.getmtime(path) > upload_ttl:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def save_upload(df, upload_key):
+    path = os.path.join(upload_dir, upload_key)
+    summary = { 'key': upload_key,
+                'columns': [str(c) for c in df.columns],
+                'nrows': df.shape[0], }
+    try:
+        # uploaded again, it is kept for another upload_ttl from now
+        os.utime(os.path.join(path, 'meta.json'))
+        os.utime(path)
+        return summary
+    except OSError:
+        pass
+
+    os.makedirs(upload_dir, exist_ok=True)
+    _prune_uploads()
+
+    # written to a temporary directory first, then moved in place at once
+    tmp_path = tempfile.mkdtemp(dir=upload_dir, prefix='.tmp-')
+    if pyarrow is not None:
+        # uncompressed, so columns can be memory-mapped
+        pyarrow.feather.write_feather(_arrow_table(df), os.path.join(tmp_path, 'table.arrow'),
+                                      compression='uncompressed')
+        meta = {**summary, 'format': 'arrow'}
+    else:
+        masked = []
+        for i, col in enumerate(df.columns):
+            values, mask = _column_arrays(df[col])
+            np.save(os.path.join(tmp_path, f'{i}.npy'), values, allow_pickle=False)
+            if mask is not None:
+                np.save(os.path.join(tmp_path, f'{i}.mask.npy'), mask, allow_pickle=False)
+                masked.append(i)
+        meta = {**summary, 'format': 'npy', 'masked': masked}
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # stored meanwhile by another process
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    return summary
+
+
+def load_columns(upload_key, columns):
+    # a DataFrame with only the requested columns of an upload
+    path = os.path.join(upload_dir, upload_key)
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+
+    if meta.get('format') == 'arrow':
+        unique = list(dict.fromkeys(columns))
+        table = pyarrow.feather.read_table(os.path.join(path, 'table.arrow'), columns=unique, memory_map=True)
+        return table.to_pandas()[list(columns)]
+
+    data = {}
+    for col in columns:
+        i = meta['columns'].index(col)
+        values = np.load(os.path.join(path, f'{i}.npy'), mmap_mode='r', allow_pickle=False)
+        if i in meta['masked']:
+            mask = np.load(os.path.join(path, f'{i}.mask.npy'), allow_pickle=False)
+            values = pd.Series(values).where(~mask, None)
+        data[col] = values
+
+    return pd.DataFrame(data, columns=columns)
@@ -7,6 +7,7 @@ if [ ! -f /.initialized ]; then
     pip install --no-cache-dir celery[librabbitmq,redis] pymongo numpy pandas openpyxl xlrd
     pip install --no-cache-dir dash dash-bootstrap-components dash-bootstrap-templates dash-cytoscape gunicorn
     pip install --no-cache-dir bibtexparser
+    pip install --no-cache-dir pyarrow zstandard
 
     touch /.initialized
 fi
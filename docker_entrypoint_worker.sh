@@ -7,7 +7,7 @@ if [ ! -f /.initialized ]; then
     pip install --no-cache-dir --upgrade pip
     pip install --no-cache-dir cython cysignals
     pip install --no-cache-dir git+https://github.com/umbibio/nlbayes-python.git
-    pip install --no-cache-dir celery[librabbitmq,redis] pymongo
+    pip install --no-cache-dir celery[librabbitmq,redis] pymongo numpy
 
     ln -s /opt/app/nlbayes_tasks.py /opt/
     touch /.initialized
@@ -0,0 +1,92 @@
+# Sampling throughput with and without the coalescing of progress reports.
+# run_sampler is run on a fixed synthetic network, once reporting every chunk
+# and evaluating the Gelman-Rubin statistic every chunk, as before the
+# ProgressPublisher, and once with the default intervals. Needs nlbayes, e.g.
+# inside the worker container:
+#
+#   cd /opt/app && python benchmarks/bench_progress.py
+#   cd /opt/app && python benchmarks/bench_progress.py --tfs 200 --targets 100 --repeat 5
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+
+# never connected to, the sampler runs without checkpoints
+os.environ.setdefault('NLB_DATA_STORE', 'mongodb://localhost:27017')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from nlbayes import ModelORNOR
+from nlbayes_sampler import SAMPLER_DEFAULTS, ProgressPublisher, run_sampler
+
+
+def make_network(n_tfs, n_targets, n_genes, seed=0):
+    rng = random.Random(seed)
+    genes = [f'g{i}' for i in range(n_genes)]
+    return {f'tf{i}': {g: rng.choice([-1, 1]) for g in rng.sample(genes, n_targets)} for i in range(n_tfs)}
+
+
+def make_evidence(network, n_active, seed=0):
+    # the targets of a few tfs, differentially expressed in their mor direction
+    rng = random.Random(seed)
+    evidence = {}
+    for tf in rng.sample(sorted(network), n_active):
+        evidence.update({g: mor for g, mor in network[tf].items() if rng.random() < 0.8})
+    return evidence
+
+
+def run(network, evidence, sampler):
+    n_published = 0
+    def publish(state, progress):
+        # what the result backend write costs locally, the serialization
+        nonlocal n_published
+        json.dumps(progress)
+        n_published += 1
+
+    progress = ProgressPublisher(publish, sampler['progress_interval'])
+    model = ModelORNOR(network, evidence)
+    timings = {}
+    t0 = time.perf_counter()
+    run_sampler(model, progress.update, sampler, timings=timings)
+    progress.flush(force=False)
+
+    return { 'wall_s': time.perf_counter() - t0,
+             'burnin_rate': progress.current.get('burnin_rate', 0.),
+             'sampling_rate': progress.current.get('sampling_rate', 0.),
+             'n_sampled': model.total_sampled,
+             'n_published': n_published, }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tfs', type=int, default=100)
+    parser.add_argument('--targets', type=int, default=50)
+    parser.add_argument('--genes', type=int, default=5000)
+    parser.add_argument('--active', type=int, default=5)
+    parser.add_argument('--n-samples', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    network = make_network(args.tfs, args.targets, args.genes)
+    evidence = make_evidence(network, args.active)
+    configs = { 'every chunk': {**SAMPLER_DEFAULTS, 'progress_interval': 0., 'diagnostic_interval': 0.},
+                'defaults': dict(SAMPLER_DEFAULTS), }
+    for sampler in configs.values():
+        sampler.update({'n_samples': args.n_samples, 'checkpoint_interval': 0})
+
+    # the configurations take turns, so drifts in machine load hit both
+    results = {name: [] for name in configs}
+    for _ in range(args.repeat):
+        for name, sampler in configs.items():
+            results[name].append(run(network, evidence, sampler))
+
+    print(f"{'config':12s} {'wall s':>9s} {'burn-in/s':>10s} {'sampling/s':>11s} {'samples':>8s} {'writes':>7s}")
+    for name, runs in results.items():
+        med = {k: statistics.median(r[k] for r in runs) for k in runs[0]}
+        print(f"{name:12s} {med['wall_s']:9.2f} {med['burnin_rate']:10.1f} {med['sampling_rate']:11.1f} "
+              f"{med['n_sampled']:8.0f} {med['n_published']:7.0f}")
+
+    base, new = (statistics.median(r['sampling_rate'] for r in results[k]) for k in configs)
+    print(f"sampling throughput: {new / max(base, 1e-9):.2f}x")
@@ -0,0 +1,37 @@
+import time
+import resource
+from contextlib import contextmanager
+
+
+@contextmanager
+def timed(timings, phase):
+    # adds the wall time spent in the block to timings[phase], in seconds
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0.) + time.perf_counter() - t0
+
+
+def reset_peak_rss():
+    # worker processes are reused across jobs, so their lifetime peak says
+    # little about the current job. Linux can reset it (VmHWM) per process
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    # peak resident memory in KiB, since the last reset when supported
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -0,0 +1,375 @@
+import os
+import time
+import ctypes
+import pickle
+import signal
+import traceback
+from queue import Empty
+
+# billiard is the multiprocessing fork shipped with celery. Unlike the standard
+# library, it lets the (daemonic) prefork pool processes start children of their own
+import billiard
+
+from nlbayes import ModelORNOR
+from nlbayes_store import Checkpointer
+from nlbayes_metrics import timed, get_peak_rss
+
+
+SAMPLER_DEFAULTS = { 'n_chains': int(os.environ.get('NLB_SAMPLER_CHAINS', 1)),
+                     'n_samples': 10000,
+                     # minimum seconds between progress writes to the result backend
+                     'progress_interval': 2.0,
+                     # minimum seconds between Gelman-Rubin evaluations for display
+                     'diagnostic_interval': 10.0,
+                     # seconds between checkpoints of the sampler state, 0 to disable. Off
+                     # by default, checkpoints need a build of nlbayes whose models pickle
+                     'checkpoint_interval': float(os.environ.get('NLB_CHECKPOINT_INTERVAL', 0)),
+                     # Gelman-Rubin levels that end the burn-in and sampling phases
+                     'burnin_gr_level': 5.0,
+                     'gr_level': 1.15,
+                     # target wall time of each sample_n call, and bounds on its size
+                     'chunk_seconds': 1.0,
+                     'min_chunk': 5,
+                     'max_chunk': 2000,
+                     # finest interval, in samples, at which sample_n checks for convergence
+                     'min_check_interval': 5, }
+
+
+class ChunkScheduler:
+    # sizes each sample_n call to take about `chunk_seconds`, using a moving
+    # average of the observed time per sample. It also sets how often sample_n
+    # checks for convergence: once per chunk while the Gelman-Rubin statistic
+    # is far from the target level or not improving, and every
+    # `min_check_interval` samples as it closes in, so convergence is caught early
+
+    def __init__(self, sampler=None):
+        sampler = {**SAMPLER_DEFAULTS, **(sampler or {})}
+        self.chunk_seconds = sampler['chunk_seconds']
+        self.min_chunk = sampler['min_chunk']
+        self.max_chunk = sampler['max_chunk']
+        self.min_check = sampler['min_check_interval']
+        self.seconds_per_sample = None
+        self.gr_level = None
+        self.gr_history = []
+
+    def start_phase(self, gr_level):
+        self.gr_level = gr_level
+        self.gr_history = []
+
+    def next_chunk(self, limit=None):
+        if self.seconds_per_sample is None:
+            n = 20
+        else:
+            n = int(self.chunk_seconds / max(self.seconds_per_sample, 1e-9))
+        n = min(max(n, self.min_chunk), self.max_chunk)
+        if limit is not None:
+            n = min(n, limit)
+
+        return n, min(self.check_interval(n), n)
+
+    def check_interval(self, n):
+        if len(self.gr_history) == 0:
+            return self.min_check
+
+        gr_stat = self.gr_history[-1]
+        # how far we are from the target, in units of the target's distance to
+        # 1. A target of 1 or less is only ever approached, never reached
+        distance = (gr_stat - 1.) / max(self.gr_level - 1., 1e-6)
+        improving = len(self.gr_history) < 2 or gr_stat < self.gr_history[-2]
+        if distance < 1.5 and improving:
+            return self.min_check
+        if distance < 4. and improving:
+            return max(n // 4, self.min_check)
+        return n
+
+    def update(self, n, seconds, gr_stat=None):
+        if n > 0:
+            sps = seconds / n
+            if self.seconds_per_sample is None:
+                self.seconds_per_sample = sps
+            else:
+                self.seconds_per_sample = 0.7 * self.seconds_per_sample + 0.3 * sps
+
+        if gr_stat is not None:
+            self.gr_history = self.gr_history[-1:] + [gr_stat]
+
+
+class ProgressPublisher:
+    # coalesces the progress reported after every sampled chunk. Reports are
+    # merged and the latest progress is handed to `publish` at most once every
+    # `min_interval` seconds, unless the state changes or a flush is forced.
+    # The result backend keeps a snapshot of the task state, not a log, so
+    # every write carries the whole progress and reports that change nothing
+    # are not written at all
+
+    def __init__(self, publish, min_interval=SAMPLER_DEFAULTS['progress_interval']):
+        self.publish = publish
+        self.min_interval = min_interval
+        self.state = None
+        self.current = {}
+        self.changed = False
+        self.last_time = float('-inf')
+        self.n_published = 0
+
+    def update(self, state, progress):
+        for k, v in progress.items():
+            if self.current.get(k) != v:
+                self.current[k] = v
+                self.changed = True
+
+        state_changed = state != self.state
+        self.state = state
+        if state_changed or time.monotonic() - self.last_time >= self.min_interval:
+            self.flush(force=state_changed)
+
+    def flush(self, force=True):
+        if not self.changed and not force:
+            return
+
+        self.publish(self.state, dict(self.current))
+        self.changed = False
+        self.last_time = time.monotonic()
+        self.n_published += 1
+
+
+def check_model_pickling():
+    # checkpoints are pickled models. Checked once when the worker starts, so a
+    # build of nlbayes that can't round-trip its models stops the worker
+    # instead of running every job without checkpoints
+    network = {'A': {'g1': 1, 'g2': -1, 'g3': 1}, 'B': {'g2': 1, 'g3': 1, 'g4': -1}}
+    evidence = {'g1': 1, 'g2': -1}
+    try:
+        model = ModelORNOR(network, evidence)
+        model.sample_n(10, 10, SAMPLER_DEFAULTS['burnin_gr_level'], False, True)
+        restored = pickle.loads(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL))
+        ok = restored.total_sampled == model.total_sampled
+    except Exception as e:
+        raise RuntimeError('ModelORNOR can not be pickled, checkpoints would not work. '
+                           'Set NLB_CHECKPOINT_INTERVAL=0 to run without them') from e
+    if not ok:
+        raise RuntimeError('ModelORNOR lost its state through pickling, checkpoints would not work. '
+                           'Set NLB_CHECKPOINT_INTERVAL=0 to run without them')
+
+
+def get_posterior(model):
+    return { 'X': model.get_posterior_mean_stat('X', 1),
+             'T': model.get_posterior_mean_stat('T', 0), }
+
+
+def run_sampler(model, report, sampler=SAMPLER_DEFAULTS, checkpoint=None, phase="BURNIN", timings=None):
+    # `checkpoint(phase, model, force=False)` is called between chunks and
+    # decides on its own when to store the state. A model restored from a
+    # checkpoint resumes at the `phase` it was saved in. The time spent in each
+    # phase is added to `timings`
+    sampler = {**SAMPLER_DEFAULTS, **sampler}
+    if checkpoint is None:
+        checkpoint = lambda phase, model, force=False: None
+    if timings is None:
+        timings = {}
+    scheduler = ChunkScheduler(sampler)
+
+    # the max Gelman-Rubin statistic is only needed for display, sample_n checks
+    # convergence on its own. Evaluate it on its own cadence, off the hot path
+    last_diagnostic = time.monotonic()
+    def progress(force=False):
+        nonlocal last_diagnostic
+        p = {'n_sampled': model.total_sampled}
+        if force or time.monotonic() - last_diagnostic >= sampler['diagnostic_interval']:
+            p['gr_stat'] = model.get_max_gelman_rubin()
+            last_diagnostic = time.monotonic()
+        return p
+
+    def sample_chunk(gr_level, limit=None):
+        n, dN = scheduler.next_chunk(limit)
+        t0, n0 = time.monotonic(), model.total_sampled
+        status = model.sample_n(n, dN, gr_level, False, True)
+        p = progress()
+        scheduler.update(model.total_sampled - n0, time.monotonic() - t0, p.get('gr_stat'))
+        return status == 0, p
+
+    # burn-in until the chains reach a loose convergence level, then discard
+    # those samples and keep sampling until convergence or n_samples
+    if phase == "BURNIN":
+        converged = False
+        report("BURNIN", {})
+        scheduler.start_phase(sampler['burnin_gr_level'])
+        phase_start, phase_sampled = time.monotonic(), model.total_sampled
+        with timed(timings, 'burnin'):
+            while not converged:
+                converged, p = sample_chunk(sampler['burnin_gr_level'])
+                report("BURNIN", p)
+                checkpoint("BURNIN", model)
+        burnin_rate = (model.total_sampled - phase_sampled) / max(time.monotonic() - phase_start, 1e-9)
+
+        model.burn_stats()
+        checkpoint("SAMPLING", model, force=True)
+        report("SAMPLING", {'burnin_rate': burnin_rate})
+
+    converged = False
+    report("SAMPLING", progress(force=True))
+    scheduler.start_phase(sampler['gr_level'])
+    phase_start, phase_sampled = time.monotonic(), model.total_sampled
+    with timed(timings, 'sampling'):
+        while model.total_sampled < sampler['n_samples'] and not converged:
+            converged, p = sample_chunk(sampler['gr_level'], sampler['n_samples'] - model.total_sampled)
+            report("SAMPLING", p)
+            checkpoint("SAMPLING", model)
+    sampling_rate = (model.total_sampled - phase_sampled) / max(time.monotonic() - phase_start, 1e-9)
+
+    report("SAMPLING", {**progress(force=True), 'sampling_rate': sampling_rate})
+
+    return model
+
+
+def load_or_create_model(network, evidence, config, checkpoint, report, timings):
+    with timed(timings, 'load_checkpoint'):
+        model, phase = checkpoint.load()
+    if model is None:
+        with timed(timings, 'build_model'):
+            model = ModelORNOR(network, evidence, **config)
+        return model, "BURNIN"
+
+    report(phase, {'resumed': True})
+    return model, phase
+
+
+def _exit_with_parent(parent_pid):
+    # a task process killed outright (hard time limit, OOM) never runs the
+    # cleanup of run_parallel_sampler. Its chains must not keep sampling, nor
+    # overwrite the checkpoints the redelivered job resumes from. On Linux the
+    # kernel kills them along with it, elsewhere they notice between chunks
+    try:
+        PR_SET_PDEATHSIG = 1
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+    except (OSError, AttributeError):
+        pass
+    if os.getppid() != parent_pid:
+        os._exit(1)
+
+
+def _run_chain(chain_id, network, evidence, config, sampler, queue, job_id, checkpoint_prefix, parent_pid):
+    _exit_with_parent(parent_pid)
+    try:
+        def report(state, progress):
+            if os.getppid() != parent_pid:
+                os._exit(1)
+            queue.put(('progress', chain_id, state, progress))
+
+        timings = {}
+        checkpoint = Checkpointer(job_id, f'{checkpoint_prefix}{chain_id}', sampler['checkpoint_interval'])
+        model, phase = load_or_create_model(network, evidence, config, checkpoint, report, timings)
+        run_sampler(model, report, sampler, checkpoint, phase, timings)
+        with timed(timings, 'posterior'):
+            posterior = get_posterior(model)
+
+        result = { 'posterior': posterior,
+                   'n_sampled': model.total_sampled,
+                   'gr_stat': model.get_max_gelman_rubin(),
+                   'timings': timings,
+                   'peak_rss_kb': get_peak_rss(), }
+        queue.put(('done', chain_id, None, result))
+    except Exception:
+        queue.put(('error', chain_id, None, traceback.format_exc()))
+
+
+def merge_posteriors(results):
+    # each chain group contributes to the posterior mean in proportion to the
+    # number of samples it collected
+    total = sum(r['n_sampled'] for r in results)
+    posterior = {}
+    for var in ['X', 'T']:
+        merged = {}
+        for r in results:
+            w = r['n_sampled'] / total
+            for k, v in r['posterior'][var].items():
+                merged[k] = merged.get(k, 0.) + w * v
+        posterior[var] = merged
+
+    return posterior
+
+
+def run_parallel_sampler(network, evidence, config, report, sampler=SAMPLER_DEFAULTS, job_id=None, checkpoint_prefix=''):
+    # each process drives its own ModelORNOR, which already runs several chains
+    # internally for the Gelman-Rubin diagnostic. The requested number of
+    # samples is split among processes, so burn-in is paid once per process
+    # while the sampling phase scales with the number of cores
+    n_chains = sampler['n_chains']
+    chain_sampler = {**sampler, 'n_samples': -(-sampler['n_samples'] // n_chains)}
+
+    queue = billiard.Queue()
+    processes = [
+        billiard.Process(target=_run_chain, args=(i, network, evidence, config, chain_sampler, queue, job_id,
+                                                  checkpoint_prefix, os.getpid()))
+        for i in range(n_chains) ]
+    for p in processes:
+        p.start()
+
+    chains = [{'state': 'PENDING', 'n_sampled': 0, 'gr_stat': float('inf')} for _ in range(n_chains)]
+    results = [None] * n_chains
+    try:
+        while any(r is None for r in results):
+            try:
+                kind, chain_id, state, payload = queue.get(timeout=5)
+            except Empty:
+                # a chain process that dies hard (e.g. killed by the OOM killer)
+                # never reports back, so we check on them while waiting
+                for i, p in enumerate(processes):
+                    if results[i] is None and not p.is_alive():
+                        raise RuntimeError(f"chain {i} exited with code {p.exitcode}")
+                continue
+
+            if kind == 'error':
+                raise RuntimeError(f"chain {chain_id} failed:\n{payload}")
+
+            if kind == 'done':
+                results[chain_id] = payload
+                chains[chain_id].update({'state': 'DONE', 'n_sampled': payload['n_sampled'], 'gr_stat': payload['gr_stat']})
+            else:
+                chains[chain_id].update(state=state, **payload)
+
+            # the job is burning in while any of the chain groups is
+            burning = any(c['state'] in ['PENDING', 'BURNIN'] for c in chains)
+            report("BURNIN" if burning else "SAMPLING",
+                   { 'n_sampled': sum(c['n_sampled'] for c in chains),
+                     'gr_stat': max(c['gr_stat'] for c in chains),
+                     'chains': [dict(c) for c in chains], })
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+
+    # chains run side by side, so the wall time of each phase is the slowest one
+    timings = {}
+    for r in results:
+        for k, v in r['timings'].items():
+            timings[k] = max(timings.get(k, 0.), v)
+
+    return merge_posteriors(results), { 'n_sampled': sum(r['n_sampled'] for r in results),
+                                        'gr_stat': max(r['gr_stat'] for r in results),
+                                        'sampling_rate': sum(c.get('sampling_rate', 0.) for c in chains),
+                                        'timings': timings,
+                                        'chains_peak_rss_kb': max(r['peak_rss_kb'] for r in results), }
+
+
+def sample_posterior(network, evidence, config, report, sampler=SAMPLER_DEFAULTS, job_id=None, checkpoint_prefix='', timings=None):
+    # runs one inference to completion, in this process or across parallel
+    # chains, and returns the posterior means. Checkpoints are stored in the
+    # job under `checkpoint_prefix` followed by the chain number
+    if timings is None:
+        timings = {}
+
+    if sampler['n_chains'] > 1:
+        posterior, summary = run_parallel_sampler(network, evidence, config, report, sampler, job_id, checkpoint_prefix)
+        for k, v in summary.pop('timings').items():
+            timings[k] = timings.get(k, 0.) + v
+        report("SAMPLING", summary)
+        return posterior
+
+    checkpoint = Checkpointer(job_id, f'{checkpoint_prefix}0', sampler['checkpoint_interval'])
+    model, phase = load_or_create_model(network, evidence, config, checkpoint, report, timings)
+    run_sampler(model, report, sampler, checkpoint, phase, timings)
+    with timed(timings, 'posterior'):
+        posterior = get_posterior(model)
+
+    return posterior
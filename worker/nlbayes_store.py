@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import pickle
+from datetime import datetime
+from functools import lru_cache
+from hashlib import sha256
+
+from pymongo import MongoClient, ReturnDocument
+import gridfs
+from gridfs.errors import FileExists
+from bson.objectid import ObjectId
+
+from network_codec import encode_network, decode_network, is_encoded_network, compact_to_dict
+
+
+mongo_url = os.environ['NLB_DATA_STORE']
+# number of decoded networks each worker process keeps in memory
+network_cache_size = int(os.environ.get('NLB_NETWORK_CACHE_SIZE', 8))
+
+
+class NLBayesFS:
+    def __init__(self, mongo_client) -> None:
+        gfs_db = mongo_client.nlbayes_gfs_db
+        self.gfs = gridfs.GridFS(gfs_db)
+
+    def save_file(self, filebytes, filename):
+        # content addressed, a blob that is already stored is found by the
+        # insert itself, without asking first
+        hash = sha256(filebytes).hexdigest()
+
+        try:
+            self.gfs.put(filebytes, _id=hash, filename=filename)
+        except FileExists:
+            # a concurrent put of the same blob may not have written its file
+            # document yet. The content is the same either way
+            for _ in range(10):
+                file = self.gfs.find_one({'_id': hash})
+                if file is not None:
+                    break
+                time.sleep(0.1)
+            if file is not None and filename != file.filename:
+                raise ValueError('filename is different')
+
+        return hash
+
+    def load_file(self, hash):
+
+        file = self.gfs.find_one({'_id': hash})
+        return file.read()
+
+    def delete_file(self, hash):
+        self.gfs.delete(hash)
+
+    def save_network(self, network):
+        return self.save_file(encode_network(network), 'network.nlbnet')
+
+    def load_network(self, hash):
+        # networks submitted before the compact format was introduced are json
+        content = self.load_file(hash)
+        if is_encoded_network(content):
+            return compact_to_dict(decode_network(content))
+
+        return json.loads(content)
+
+
+# MongoClient keeps its own connection pool and monitor threads, which are not
+# fork safe. We keep one client per process, created lazily after the pool
+# process has been forked, and reuse it for every task that process runs
+_client = None
+_client_pid = None
+_fs = None
+
+
+def get_mongo_client():
+    global _client, _client_pid, _fs
+
+    if _client is None or _client_pid != os.getpid():
+        _client = MongoClient(mongo_url)
+        _client_pid = os.getpid()
+        _fs = None
+
+    return _client
+
+
+def get_fs():
+    global _fs
+
+    client = get_mongo_client()
+    if _fs is None:
+        _fs = NLBayesFS(client)
+
+    return _fs
+
+
+def get_jobs():
+    return get_mongo_client().nlbayes_job_db.jobs
+
+
+def close_mongo_client():
+    global _client, _client_pid, _fs
+
+    if _client is not None and _client_pid == os.getpid():
+        _client.close()
+    _client, _client_pid, _fs = None, None, None
+
+
+# the same few predefined networks are used by most jobs. Their hash is the
+# content hash, so a cached entry never goes stale
+@lru_cache(maxsize=network_cache_size)
+def load_network(network_hash):
+    return get_fs().load_network(network_hash)
+
+
+class Checkpointer:
+    # periodically stores the pickled state of a model in GridFS and records
+    # it in the job document, under the id of the chain that owns it, so a
+    # redelivered task can continue from there instead of starting over.
+    # Only the latest checkpoint of each chain is kept
+
+    def __init__(self, job_id, chain_id=0, interval=300.):
+        self.job_id = job_id
+        self.chain_id = str(chain_id)
+        self.key = f'checkpoints.{chain_id}'
+        self.interval = interval
+        self.enabled = job_id is not None and interval > 0
+        self.last_time = time.monotonic()
+
+    def load(self):
+        if not self.enabled:
+            return None, None
+
+        job = get_jobs().find_one({'_id': ObjectId(self.job_id)}, {self.key: 1})
+        checkpoint = (job or {}).get('checkpoints', {}).get(self.chain_id)
+        if checkpoint is None:
+            return None, None
+
+        try:
+            model = pickle.loads(get_fs().load_file(checkpoint['hash']))
+        except Exception as e:
+            print(f"failed to load checkpoint for job {self.job_id}: {e}", flush=True)
+            return None, None
+
+        return model, checkpoint['phase']
+
+    def __call__(self, phase, model, force=False):
+        if not self.enabled:
+            return
+
+        if not force and time.monotonic() - self.last_time < self.interval:
+            return
+
+        # the worker checks at startup that models can be pickled, a failure
+        # here is a bug and fails the job instead of going unnoticed
+        filebytes = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+
+        hash = get_fs().save_file(filebytes, 'checkpoint.pkl')
+        checkpoint = { 'hash': hash,
+                       'phase': phase,
+                       'time': datetime.now().isoformat(), }
+        job = get_jobs().find_one_and_update(
+            {'_id': ObjectId(self.job_id)}, {'$set': {self.key: checkpoint}},
+            projection={self.key: 1}, return_document=ReturnDocument.BEFORE)
+        self.last_time = time.monotonic()
+
+        previous = (job or {}).get('checkpoints', {}).get(self.chain_id)
+        if previous is not None and previous['hash'] != hash:
+            get_fs().delete_file(previous['hash'])
+
+
+def clear_checkpoints(job_id):
+    job = get_jobs().find_one_and_update(
+        {'_id': ObjectId(job_id)}, {'$unset': {'checkpoints': ''}},
+        projection={'checkpoints': 1}, return_document=ReturnDocument.BEFORE)
+
+    for checkpoint in (job or {}).get('checkpoints', {}).values():
+        get_fs().delete_file(checkpoint['hash'])
@@ -1,112 +1,257 @@
 import json
 from datetime import datetime
-from hashlib import sha256
 import os
 import socket
 
 broker = os.environ['NLB_QUEUE_BROKER']
 backend = os.environ['NLB_QUEUE_BACKEND']
-mongo_url = os.environ['NLB_DATA_STORE']
+# recycle a pool process once its resident memory goes over this many KiB.
+# The check runs after a task completes, so a running job is never interrupted
+max_memory_per_child = int(os.environ.get('NLB_WORKER_MAX_MEMORY', 4 * 1024 * 1024))
+# seconds a job may run. Must stay below the broker's consumer_timeout (48 h,
+# see rabbitmq/20-nlbayes.conf), past which the unacknowledged job would be
+# delivered again while still running
+task_time_limit = int(os.environ.get('NLB_TASK_TIME_LIMIT', 47 * 3600))
+# times a job may be started. With late acks, a job whose pool process dies,
+# e.g. killed by the OOM killer, is delivered again. One that always kills
+# its process fails after this many starts instead of blocking its queue
+max_job_attempts = int(os.environ.get('NLB_MAX_JOB_ATTEMPTS', 3))
 
 from celery import Celery
-from pymongo import MongoClient
-import gridfs
+from kombu import Queue
+from celery.signals import worker_process_init, worker_process_shutdown, task_postrun, task_failure, task_revoked
 from bson.objectid import ObjectId
+from pymongo import ReturnDocument
 
-from nlbayes import ModelORNOR
+# nlbayes is imported (by nlbayes_sampler) once in the main worker process,
+# pool processes inherit it
+from nlbayes_sampler import SAMPLER_DEFAULTS, ProgressPublisher, sample_posterior, check_model_pickling
+from nlbayes_store import get_mongo_client, get_fs, get_jobs, close_mongo_client, load_network
+from nlbayes_store import clear_checkpoints
+from nlbayes_metrics import timed, reset_peak_rss, get_peak_rss
 
 
-class NLBayesFS:
-    def __init__(self, mongo_client) -> None:
-        gfs_db = mongo_client.nlbayes_gfs_db
-        self.gfs = gridfs.GridFS(gfs_db)
+worker = Celery('nlbayes_jobs', backend=backend, broker=broker)
+worker.conf.update(
+    worker_max_memory_per_child=max_memory_per_child,
+    # inference jobs are long, don't let a process hold on to jobs it can't start yet
+    worker_prefetch_multiplier=1,
+    task_time_limit=task_time_limit,
+    # size-class queues filled by the dash app, which declares them the same way.
+    # Each worker service consumes the ones given with -Q
+    task_queues=[Queue(q, queue_arguments={'x-max-priority': 9}) for q in ['ornor_small', 'ornor_large']],
+)
 
-    def save_file(self, filebytes, filename):
-        hash = sha256(filebytes).hexdigest()
+# fail at startup, not silently in every job, if checkpoints are enabled but
+# can't work
+if SAMPLER_DEFAULTS['checkpoint_interval'] > 0:
+    check_model_pickling()
 
-        if not self.gfs.exists(_id=hash):
-            self.gfs.put(filebytes, _id=hash, filename=filename)
-        else:
-            file = self.gfs.find_one({'_id': hash})
-            if filename != file.filename:
-                raise ValueError('filename is different')
 
-        return hash
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    # warm up the connection pool before the first task arrives
+    get_mongo_client()
 
-    def load_file(self, hash):
 
-        file = self.gfs.find_one({'_id': hash})
-        return file.read()
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    close_mongo_client()
 
 
-worker = Celery('nlbayes_jobs', backend=backend, broker=broker)
-@worker.task(bind=True, name="ornor_inference")
-def taskModelORNOR(self, job_id):
-    mongo_client = MongoClient(mongo_url)
-    jobs = mongo_client.nlbayes_job_db.jobs
-    fs = NLBayesFS(mongo_client)
+def progress_channel(task_id):
+    # must match the channel the dash app subscribes to
+    return f'nlbayes:progress:{task_id}'
 
-    query = {'_id': ObjectId(job_id)}
-    job = jobs.find_one(query)
 
-    network_hash = job['network_hash']
-    evidence_hash = job['evidence_hash']
-    config = job['config']
+def publish_progress(task_id, status, result):
+    # the state is also pushed on a redis channel, the dash app relays it to
+    # the browsers watching the job. The result backend keeps the state for
+    # clients that poll, so a failed publish is only logged
+    client = getattr(worker.backend, 'client', None)
+    # other backends, e.g. memcached, have a client too, without pub/sub
+    if not hasattr(client, 'publish'):
+        return
+    try:
+        message = json.dumps({'status': status, 'result': result}, default=str)
+        client.publish(progress_channel(task_id), message)
+    except Exception as e:
+        print(f"failed to publish progress of {task_id}: {e}", flush=True)
 
-    network = json.loads(fs.load_file(network_hash))
-    evidence = json.loads(fs.load_file(evidence_hash))
-    model = ModelORNOR(network, evidence, **config)
 
-    start_time = datetime.now()
-    meta = { 'job_id': job_id,
-             'worker_id': socket.gethostname(),
-             'start_time': start_time.isoformat(), }
-    jobs.update_one(query, {"$set": {'meta': meta}}, upsert=False)
+@task_postrun.connect
+def publish_final_state(task_id=None, task=None, retval=None, state=None, **kwargs):
+    # sent after the result was stored, so subscribers can stop listening
+    if task is not None and task.name in ['ornor_inference', 'ornor_batch_inference']:
+        publish_progress(task_id, state, retval if state == 'SUCCESS' else str(retval))
 
-    converged = False
-    self.update_state(state="BURNIN", meta=meta)
-    while not converged:
-        status = model.sample_n(20, 5, 5.0, False, True)
-        converged = status == 0
 
-        current_time = datetime.now()
-        elapsed_time = current_time - start_time
-        progress = { 'n_sampled': model.total_sampled,
-                     'gr_stat': model.get_max_gelman_rubin(), 
-                     'elapsed_time': str(elapsed_time), }
-        meta.update(progress)
-        self.update_state(state="BURNIN", meta=meta)
-
-    model.burn_stats()
-
-    N = 10000
-    converged = False
-    self.update_state(state="SAMPLING", meta=meta)
-    while model.total_sampled < N and not converged:
-        n = min(20, N - model.total_sampled)
-        status = model.sample_n(n, 5, 1.15, False, True)
-        converged = status == 0
+def record_terminal_state(job_id, task_id, state, error):
+    # the job document says for good that the job won't finish. The result
+    # backend forgets after result_expires, and the dash app must not attach
+    # new submissions to a job that is never going to run. Its checkpoints
+    # are of no use anymore, a new run starts over
+    get_jobs().update_one({'_id': ObjectId(job_id), 'task_id': task_id},
+                          {'$set': {'state': state, 'error': error, 'end_time': datetime.now().isoformat()}})
+    clear_checkpoints(job_id)
+
+
+@task_failure.connect
+def record_failure(sender=None, task_id=None, exception=None, kwargs=None, **other):
+    if sender is not None and sender.name in ['ornor_inference', 'ornor_batch_inference'] and kwargs:
+        record_terminal_state(kwargs['job_id'], task_id, 'FAILURE', repr(exception))
+
+
+@task_revoked.connect
+def record_revoked(sender=None, request=None, **other):
+    kwargs = getattr(request, 'kwargs', None)
+    if sender is not None and sender.name in ['ornor_inference', 'ornor_batch_inference'] and kwargs:
+        record_terminal_state(kwargs['job_id'], request.id, 'REVOKED', None)
+
+
+class InferenceJob:
+    # what every inference task does around its sampling: reads the job
+    # document, keeps its meta, publishes progress, records timings and
+    # stores the results
+
+    def __init__(self, task, job_id):
+        self.task = task
+        self.job_id = job_id
+        self.query = {'_id': ObjectId(job_id)}
+        self.job = get_jobs().find_one_and_update(self.query, {'$inc': {'attempts': 1}},
+                                                  return_document=ReturnDocument.AFTER)
+        finished = 'posterior_hash' in self.job or 'summary_hash' in self.job
+        if self.job['attempts'] > max_job_attempts and not finished:
+            raise RuntimeError(f"job {job_id} was started {max_job_attempts} times without finishing, giving up")
+        self.config = self.job['config']
+        self.sampler = {**SAMPLER_DEFAULTS, **self.config.pop('sampler', {})}
+        self.timings = {}
+        # parallel chains run in child processes, each measures its own peak
+        self.chains_peak_rss_kb = None
+        reset_peak_rss()
+
+    def start(self, **meta):
+        self.start_time = datetime.now()
+        self.meta = { 'job_id': self.job_id,
+                      'worker_id': socket.gethostname(),
+                      'start_time': self.start_time.isoformat(),
+                      'n_chains': self.sampler['n_chains'],
+                      **meta, }
+        if 'meta' in self.job:
+            # resuming, keep the original start time
+            self.meta['start_time'] = self.job['meta']['start_time']
+            self.start_time = datetime.fromisoformat(self.meta['start_time'])
+        get_jobs().update_one(self.query, {"$set": {'meta': self.meta}}, upsert=False)
+
+        self.progress = ProgressPublisher(self.publish, self.sampler['progress_interval'])
+
+    def publish(self, state, progress):
+        if 'chains_peak_rss_kb' in progress:
+            self.chains_peak_rss_kb = max(self.chains_peak_rss_kb or 0, progress['chains_peak_rss_kb'])
+        self.meta.update(progress)
+        self.meta.update({'elapsed_time': str(datetime.now() - self.start_time)})
+        self.task.update_state(state=state, meta=self.meta)
+        publish_progress(self.task.request.id, state, self.meta)
+
+    def sample(self, network, evidence, checkpoint_prefix=''):
+        return sample_posterior(network, evidence, self.config, self.progress.update, self.sampler,
+                                self.job_id, checkpoint_prefix, self.timings)
+
+    def load_json(self, hash, timing):
+        with timed(self.timings, timing):
+            return json.loads(get_fs().load_file(hash))
+
+    def save_json(self, data, filename):
+        with timed(self.timings, 'save_result'):
+            return get_fs().save_file(json.dumps(data).encode(), filename)
+
+    def record(self, data):
+        get_jobs().update_one(self.query, {"$set": data}, upsert=False)
+
+    def finish(self, **data):
+        self.progress.flush(force=False)
 
         current_time = datetime.now()
-        elapsed_time = current_time - start_time
-        progress = { 'n_sampled': model.total_sampled,
-                     'gr_stat': model.get_max_gelman_rubin(),
-                     'elapsed_time': str(elapsed_time), }
-        meta.update(progress)
-        self.update_state(state="SAMPLING", meta=meta)
+        self.meta.update({'end_time': current_time.isoformat(),
+                          'elapsed_time': str(current_time - self.start_time),
+                          'n_progress_updates': self.progress.n_published,
+                          'timings': self.timings,
+                          'peak_rss_kb': get_peak_rss(), })
+        if self.chains_peak_rss_kb is not None:
+            # the largest over every run of the job, e.g. each set of a batch
+            self.meta['chains_peak_rss_kb'] = self.chains_peak_rss_kb
+        self.task.update_state(state="COMPLETE", meta=self.meta)
+        publish_progress(self.task.request.id, "COMPLETE", self.meta)
+
+        data = {'meta': self.meta, **data}
+        self.record(data)
+        clear_checkpoints(self.job_id)
+
+        return data
+
+
+# with late acks, a job whose worker is lost mid-run goes back to the queue
+# and the next worker resumes it from its last checkpoint
+@worker.task(bind=True, name="ornor_inference", acks_late=True, reject_on_worker_lost=True)
+def taskModelORNOR(self, job_id):
+    job = InferenceJob(self, job_id)
+
+    # the task may be delivered again after it had already finished
+    if 'posterior_hash' in job.job:
+        return { 'meta': job.job['meta'],
+                 'posterior_hash': job.job['posterior_hash'], }
+
+    with timed(job.timings, 'load_network'):
+        network = load_network(job.job['network_hash'])
+    evidence = job.load_json(job.job['evidence_hash'], 'load_evidence')
+
+    job.start()
+    posterior = job.sample(network, evidence)
+    posterior_hash = job.save_json(posterior, 'posterior.json')
+
+    return job.finish(posterior_hash=posterior_hash)
+
+
+@worker.task(bind=True, name="ornor_batch_inference", acks_late=True, reject_on_worker_lost=True)
+def taskBatchModelORNOR(self, job_id):
+    # many evidence sets against the same network. The network is loaded once
+    # and every posterior is recorded as soon as it is ready, so a redelivered
+    # batch continues with the evidence sets that are still missing
+    job = InferenceJob(self, job_id)
+
+    if 'summary_hash' in job.job:
+        return { 'meta': job.job['meta'],
+                 'posterior_hashes': job.job['posterior_hashes'],
+                 'summary_hash': job.job['summary_hash'], }
+
+    evidence_hashes = job.job['evidence_hashes']
+    with timed(job.timings, 'load_network'):
+        network = load_network(job.job['network_hash'])
+
+    job.start(n_evidence=len(evidence_hashes))
 
-    meta.update({'end_time': current_time.isoformat()})
-    self.update_state(state="COMPLETE", meta=meta)
+    posterior_hashes = job.job.get('posterior_hashes', [None] * len(evidence_hashes))
+    posteriors = []
+    for i, evidence_hash in enumerate(evidence_hashes):
+        job.progress.update("SAMPLING", {'evidence_index': i, 'n_done': sum(h is not None for h in posterior_hashes)})
 
-    posterior = { 'X': model.get_posterior_mean_stat('X', 1),
-                  'T': model.get_posterior_mean_stat('T', 0), }
-    posterior_b = json.dumps(posterior).encode()
-    posterior_hash = fs.save_file(posterior_b, 'posterior.json')
+        if posterior_hashes[i] is not None:
+            posteriors.append(job.load_json(posterior_hashes[i], 'load_result'))
+            continue
 
-    data = { 'meta': meta,
-             'posterior_hash': posterior_hash, }
-    jobs.update_one(query, {"$set": data}, upsert=False)
+        evidence = job.load_json(evidence_hash, 'load_evidence')
+        posteriors.append(job.sample(network, evidence, f'{i}-'))
+        posterior_hashes[i] = job.save_json(posteriors[-1], 'posterior.json')
+        job.record({'posterior_hashes': posterior_hashes})
+        clear_checkpoints(job_id)
 
-    mongo_client.close()
+    # one table per posterior statistic, with a column per evidence set
+    summary = { 'evidence_hashes': evidence_hashes,
+                'posterior_hashes': posterior_hashes, }
+    for var in ['X', 'T']:
+        tfs = sorted(set(k for p in posteriors for k in p[var].keys()))
+        summary[var] = {tf: [p[var].get(tf) for p in posteriors] for tf in tfs}
+    summary_hash = job.save_json(summary, 'summary.json')
 
-    return data
+    job.progress.update("SAMPLING", {'n_done': len(evidence_hashes)})
+    return job.finish(posterior_hashes=posterior_hashes, summary_hash=summary_hash)